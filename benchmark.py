@@ -0,0 +1,144 @@
+# Reproducible benchmarks for all the trainers, on the corpora in data/.
+#
+# Each (trainer, corpus, vocab size) case runs in a fresh process, so that its
+# peak RSS is its own, and records train and tokenize wall times (the best of
+# --repeat runs), peak RSS, tokenize throughput and the compression ratio.
+# Results are written to JSON, and compared to a baseline JSON if given:
+#
+#   python benchmark.py --out new.json --baseline old.json --threshold 0.1
+#
+# exits with status 1 if any case got slower, bigger or compressed worse by
+# more than the threshold (a fraction).
+
+from contextlib import redirect_stdout
+import multiprocessing
+import argparse
+import platform
+import resource
+import glob
+import json
+import io
+import os
+import sys
+import time
+
+import bpe
+import bke
+import bxe_with_score
+import bpe_cond_score
+import bpe_less_greedy
+
+# name -> (train(text, vocab_size), tokenize(text, merge_tree), vocab -> detokenize, max corpus bytes).
+# The slower trainers only see a prefix of each corpus by default.
+TRAINERS = {
+    'bpe': (bpe.train, bpe.tokenize, bpe.detokenize, None),
+    'bpe_split': (lambda text, v: bpe.train(text, v, split_pattern=bpe.GPT2_SPLIT_PATTERN),
+                  lambda text, mt: bpe.tokenize(text, mt, bpe.GPT2_SPLIT_PATTERN), bpe.detokenize, None),
+    'bke': (lambda text, v: bke.train(text, v, k=3), lambda text, mt: bke.tokenize(text, mt, 3), bke.detokenize, 200_000),
+    'bxe_with_score': (lambda text, v: bxe_with_score.train(text, v, x=4),
+                       lambda text, mt: bxe_with_score.tokenize(text, mt, 4), bxe_with_score.detokenize, 100_000),
+    'bpe_cond_score': (bpe_cond_score.train, bpe_cond_score.tokenize, bpe_cond_score.detokenize, None),
+    'bpe_less_greedy': (bpe_less_greedy.train_bpe_heuristic, lambda text, mt: bpe_less_greedy.tokenize(text, mt, 3),
+                        bpe_less_greedy.detokenize, 2_000),
+}
+# Higher is worse for all of these but compression_ratio.
+METRICS = ['train_secs', 'tokenize_secs', 'peak_rss_mb', 'compression_ratio']
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, KB elsewhere.
+
+
+def read_corpus(path, max_bytes):
+    text = open(path, encoding='utf-8').read()
+    if max_bytes is not None:
+        text = text.encode('utf-8')[:max_bytes].decode('utf-8', errors='ignore')
+    return text
+
+
+def best_time(f, repeat):  # Returns f's result and its best wall time.
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):  # The trainers are chatty.
+            res = f()
+        times.append(time.perf_counter() - start)
+    return res, min(times)
+
+
+def run_case(trainer, corpus, vocab_size, max_bytes, repeat):  # Runs in its own process.
+    train, tokenize, detokenize, default_max_bytes = TRAINERS[trainer]
+    text = read_corpus(corpus, max_bytes or default_max_bytes)
+    (merge_tree, vocab), train_secs = best_time(lambda: train(text, vocab_size), repeat)
+    tokens, tokenize_secs = best_time(lambda: tokenize(text, merge_tree), repeat)
+    n_bytes = len(text.encode('utf-8'))
+    return {
+        'trainer': trainer, 'corpus': os.path.basename(corpus), 'vocab_size': vocab_size,
+        'n_bytes': n_bytes, 'n_merges': len(merge_tree), 'n_tokens': len(tokens),
+        'train_secs': train_secs, 'tokenize_secs': tokenize_secs,
+        'tokens_per_sec': len(tokens) / tokenize_secs if tokenize_secs else None,
+        'compression_ratio': n_bytes / len(tokens) if tokens else None,
+        'roundtrip_ok': detokenize(tokens, vocab) == text,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / 2**20,
+    }
+
+
+def case_key(res):
+    return res['trainer'], res['corpus'], res['vocab_size']
+
+
+def compare(results, baseline, threshold):  # Returns a description of each regression.
+    baseline = {case_key(r): r for r in baseline['results']}
+    regressions = []
+    for res in results:
+        base = baseline.get(case_key(res))
+        if base is None: continue
+        for metric in METRICS:
+            new, old = res[metric], base[metric]
+            if not new or not old: continue
+            change = old / new - 1 if metric == 'compression_ratio' else new / old - 1
+            change = round(change, 3)  # As reported, so noise (e.g. a few KB of RSS) isn't a +0.0% regression.
+            if change > threshold:
+                regressions.append(f'{case_key(res)} {metric}: {old:.3f} -> {new:.3f} ({change:+.1%} worse)')
+        if base['roundtrip_ok'] and not res['roundtrip_ok']:
+            regressions.append(f'{case_key(res)} no longer round-trips')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the trainers on the corpora in data/.')
+    parser.add_argument('--trainers', nargs='+', default=list(TRAINERS), choices=list(TRAINERS))
+    parser.add_argument('--corpora', nargs='+', default=sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'data', '*.txt'))))
+    parser.add_argument('--vocab-sizes', nargs='+', type=int, default=[512, 1024, 2048])
+    parser.add_argument('--max-bytes', type=int, default=None, help="Overrides each trainer's default.")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')  # A fresh process, for a clean peak RSS.
+    results = []
+    for trainer in args.trainers:
+        for corpus in args.corpora:
+            for vocab_size in args.vocab_sizes:
+                with ctx.Pool(1) as pool:
+                    res = pool.apply(run_case, (trainer, corpus, vocab_size, args.max_bytes, args.repeat))
+                print(f"{trainer:16} {res['corpus']:16} {vocab_size:6,}: train {res['train_secs']:7.2f}s, "
+                      f"tokenize {res['tokenize_secs']:6.2f}s, {res['peak_rss_mb']:7.1f}MB, "
+                      f"{res['compression_ratio']:.2f} bytes/token")
+                results.append(res)
+
+    meta = {'python': sys.version, 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'repeat': args.repeat}
+    with open(args.out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for r in regressions:
+            print('REGRESSION:', r)
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions beyond {args.threshold:.0%}.')
+
+
+if __name__ == '__main__':
+    main()
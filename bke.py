@@ -1,26 +1,28 @@
 from util.mytimeit import timeit
+from util import batch, tupleencoder
+from util.dataset import as_tokens
+from util.rawtext import describe, open_bytes
 from datastructures import Multiset, IndexedKList
-from collections import deque
+from datastructures.ngrams import count_ngrams
 
 
 def build_indexed_list(text, k):  # Create an IndexedKList with the encoded bytes.
-    return IndexedKList((t for t in text.encode('utf-8')), k)
+    with open_bytes(text) as data:
+        return IndexedKList(data, k)
 
 
 def init_stats(text, k):  # Initialize a Multiset with all overlapping k-tuples.
-    text = text.encode('utf-8')
-    d = deque(text[:k-1], maxlen=k)
-    res = Multiset()
-    for t in text[k-1:]:
-        d.append(t)
-        res.add(tuple(d))
-    return res
+    with open_bytes(text) as data:
+        return Multiset(count_ngrams(data, k))
 
 
 def merge(tup, new_id, indexed_list: IndexedKList, stats:Multiset|None=None):
+    n_merges = 0
     k = len(tup)
-    for node in indexed_list.index[tup]:
+    nodes = indexed_list.index.get(tup, ())
+    for node in nodes:
         if node.tuple(k) != tup: continue
+        n_merges += 1
         # Remove old items from stats:
         if stats is not None:
             n, i = node.go_back(k - 1)
@@ -42,16 +44,22 @@ def merge(tup, new_id, indexed_list: IndexedKList, stats:Multiset|None=None):
                 if len(t) < k: break
                 stats.add(t)
                 n = n.next
+    indexed_list.n_skipped += len(nodes) - n_merges
+    indexed_list.drop_from_index(tup)  # It can't appear again.
+    indexed_list.maybe_compact()
+    return n_merges
 
 
-def train(text, vocab_size, k=2, verbose=False):
-    print(f'Training tokenizer on text of length {len(text):,} with vocab of size {vocab_size:,}.')
+def train(text, vocab_size, k=2, verbose=False, metrics=None):  # metrics is a util.metrics.TrainingMetrics.
+    print(f'Training tokenizer on {describe(text)} with vocab of size {vocab_size:,}.')
     n_merges = vocab_size - 256
     vocab = {i: bytes([i]) for i in range(256)}
     merge_tree = []
     indexed_list = timeit(lambda: build_indexed_list(text, k), 'build_indexed_list')
     stats = timeit(lambda: init_stats(text, k), 'init_stats')
+    if metrics is not None: metrics.start(indexed_list, stats)
     for i in range(n_merges):
+        if metrics is not None: metrics.begin_merge(indexed_list, stats)
         if not stats: break
         top_tup = stats.most_common
         new_id = len(vocab)
@@ -59,17 +67,36 @@ def train(text, vocab_size, k=2, verbose=False):
         vocab[new_id] = b''.join([vocab[top_tup[i]] for i in range(k)])
         if verbose:
             print(f"Merge {i+1}/{n_merges}: {top_tup} -> {new_id} ({vocab[new_id]}) had {stats.count(top_tup)} occurrences")
-        merge(top_tup, new_id, indexed_list, stats)
+        n_merged = merge(top_tup, new_id, indexed_list, stats)
+        if metrics is not None: metrics.end_merge(i, top_tup, new_id, n_merged, indexed_list, stats)
     return merge_tree, vocab
 
 
-def tokenize(text, merge_tree, k):
+def tokenize(text, merge_tree, k, out=None):  # For out, see util/dataset.py.
     l = build_indexed_list(text, k)
     for pair, new_id in merge_tree:
         merge(pair, new_id, l, None)
-    return [node.val for node in l]
+    if out is None: return [node.val for node in l]
+    return as_tokens((node.val for node in l), 256 + len(merge_tree), out)
+
+
+def get_trie(merge_tree, k):  # For tokenize_fast, see util/tupleencoder.py.
+    return tupleencoder.get_trie(merge_tree, (k,))
+
+
+def tokenize_fast(text, trie, k):  # Like tokenize, with trie = get_trie(merge_tree, k).
+    with open_bytes(text) as data:
+        return tupleencoder.encode(data, trie, k)
+
+
+def tokenize_batch(texts, merge_tree, k, workers=None, out=None):  # tokenize on a process pool.
+    return batch.tokenize_batch(tokenize, texts, merge_tree, (k, out), workers)
+
+
+def detokenize_bytes(seq, vocab):  # The raw bytes, which might end (or, for a slice of seq, start) mid-character.
+    return b''.join((vocab[t] for t in seq))
 
 
 def detokenize(seq, vocab):
-    return b''.join((vocab[t] for t in seq)).decode('utf-8')
+    return detokenize_bytes(seq, vocab).decode('utf-8')
 
@@ -1,61 +1,564 @@
 from util.mytimeit import timeit
+from util import batch
+from util.dataset import as_tokens, concat_tokens, empty_tokens
+from util.modelfile import MergeTree
+from util.rawtext import describe, is_buffer, iter_text, open_bytes
 from itertools import pairwise
-from datastructures import Multiset, IndexedList
+from collections import Counter, deque
+from functools import partial
+import bisect
+import codecs
+import heapq
+import os
+import pickle
+import re
+from datastructures import Multiset, BucketMultiset, SpaceSavingMultiset, IndexedList, CompactIndexedList, LRUCache
 
+# Optionally, the text is first split into chunks (e.g. words) and merges never
+# cross chunk boundaries. This is the GPT-2 pattern, adapted to the re module.
+GPT2_SPLIT_PATTERN = r"""'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+"""
 
-def build_indexed_list(text):  # Create an IndexedList with the encoded bytes.
-    return IndexedList(t for t in text.encode('utf-8'))
+
+def split_chunks(text, split_pattern):  # The encoded chunks, in order.
+    return [chunk.encode('utf-8') for chunk in re.findall(split_pattern, text)]
+
+
+# Training can also stream its input: text can be a str, a path (os.PathLike)
+# to a utf-8 file, a buffer of utf-8 bytes (see util/rawtext.py) or an iterable
+# of documents (each any of these). Files are memory-mapped, and documents are
+# hard boundaries: no pair spans two of them.
+def as_documents(text):
+    return [text] if isinstance(text, (str, os.PathLike)) or is_buffer(text) else text
+
+
+def iter_bytes(doc):  # The encoded bytes of a document, streamed if it's a path.
+    with open_bytes(doc) as data:
+        yield from data
+
+
+def iter_chunks(doc, split_pattern):  # The encoded chunks of a document, streamed if it's a path or a buffer.
+    if isinstance(doc, str):
+        yield from split_chunks(doc, split_pattern)
+        return
+    tail = ''
+    for block in iter_text(doc):
+        chunks, tail = split_stable_chunks(tail + block, split_pattern)
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+    yield from split_chunks(tail, split_pattern)
+
+
+def split_stable_chunks(text, split_pattern):  # The chunks no text appended to text can change, and the rest.
+    chunks = re.findall(split_pattern, text)
+    if not chunks: return [], text
+    # The last chunks might change with more text (e.g. "'" + "ve"), so they're split again with it.
+    # The pattern looks at most 2 characters past a chunk, so 3 characters are enough.
+    n = len(chunks) - 1
+    tail = chunks[n]
+    while n > 0 and len(tail) < 3:
+        n -= 1
+        tail = chunks[n] + tail
+    return chunks[:n], tail
+
+
+# Splits a document (see as_documents) into str pieces of at least max_size characters, for batch.tokenize_batch,
+# which are split into the same chunks as the document was. A piece ends at the start of a chunk, and only where
+# splitting the text of the last few chunks up to there again gives the same chunks: then none of them depended
+# on the text after it (the pattern looks at most 2 characters past a chunk, see split_stable_chunks), and the
+# next piece is split like the document from there on (assuming the pattern doesn't look behind, like GPT-2's).
+def split_document(doc, max_size, split_pattern):
+    text = doc if isinstance(doc, str) else ''.join(iter_text(doc))
+    pieces, start, last_chunks = [], 0, deque(maxlen=4)
+    for match in re.finditer(split_pattern, text):
+        end = match.start()
+        if end - start >= max_size and last_chunks and end - last_chunks[0].start() >= 3:
+            if re.findall(split_pattern, text[last_chunks[0].start():end]) == [m.group() for m in last_chunks]:
+                pieces.append(text[start:end])
+                start = end
+        last_chunks.append(match)
+    pieces.append(text[start:])
+    return pieces
+
+
+def count_chunks(text, split_pattern):  # Map each unique chunk to its count.
+    return Counter(chunk for doc in as_documents(text) for chunk in iter_chunks(doc, split_pattern))
+
+
+def build_indexed_list(text, split_pattern=None):  # Create an IndexedList with the encoded bytes.
+    if split_pattern is None:
+        return IndexedList(iter_bytes(text))
+    indexed_list = IndexedList()
+    for chunk in iter_chunks(text, split_pattern):
+        indexed_list.add_chunk(chunk)
+    return indexed_list
+
+
+def build_documents_indexed_list(text, indexed_list_type=IndexedList):  # Each document is a separate chunk.
+    indexed_list = indexed_list_type()
+    for doc in as_documents(text):
+        indexed_list.add_chunk(iter_bytes(doc))
+    return indexed_list
+
+
+def build_weighted_indexed_list(chunk_counts, indexed_list_type=IndexedList):  # Each unique chunk once, weighted by its count.
+    indexed_list = indexed_list_type()
+    for chunk, count in chunk_counts.items():
+        indexed_list.add_chunk(chunk, count)
+    return indexed_list
 
 
 def init_pairs_stats(text):  # Initialize a Multiset with all overlapping pairs.
     # For text "aaabd" the multiset will contain: {(a,a): 2, (a, b): 1, (b, d): 1}
-    return Multiset(pairwise(t for t in text.encode('utf-8')))
+    return Multiset(pairwise(iter_bytes(text)))
+
+
+def init_stats_from_indexed_list(indexed_list, stats_type=Multiset):  # The index already has every pair, once per occurrence.
+    stats = stats_type()
+    for pair in indexed_list.index:
+        stats.add(pair, indexed_list.index_weight(pair))
+    return stats
+
+
+def init_weighted_pairs_stats(chunk_counts, stats_type=Multiset):  # Same, but a chunk's pairs are added count times at once.
+    stats = stats_type()
+    for chunk, count in chunk_counts.items():
+        for pair in pairwise(chunk):
+            stats.add(pair, count)
+    return stats
 
 
-def merge(pair, new_id, indexed_list: IndexedList, stats:Multiset|None=None):
-    for node in indexed_list.index[pair]:
+def merge(pair, new_id, indexed_list: IndexedList|CompactIndexedList, stats:Multiset|BucketMultiset|None=None):
+    n_merges = 0
+    nodes = indexed_list.index.get(pair, ())  # The pair might not appear at all.
+    for node in nodes:
         if node.val != pair[0] or node.next is None or node.next.val != pair[1]:
             continue  # The index was stale - continue.
+        n_merges += 1
         # Say we're merging "bc" to "X" in "abcd", and the node we're visiting now is "b".
         if stats is not None:  # Update the stats.
-            stats.remove(pair)  # Remove "bc".
+            w = node.weight  # The number of copies of this chunk.
+            stats.remove(pair, w)  # Remove "bc".
             if node.next.next is not None:
-                stats.remove((node.next.val, node.next.next.val))  # Remove "cd".
-                stats.add((new_id, node.next.next.val))  # Add "Xd".
+                stats.remove((node.next.val, node.next.next.val), w)  # Remove "cd".
+                stats.add((new_id, node.next.next.val), w)  # Add "Xd".
             if node.prev is not None:
-                stats.remove((node.prev.val, pair[0]))  # Remove "ab".
-                stats.add((node.prev.val, new_id))  # Add "aX".
+                stats.remove((node.prev.val, pair[0]), w)  # Remove "ab".
+                stats.add((node.prev.val, new_id), w)  # Add "aX".
         node.next.delete()  # Delete "c", we now have "abd".
         node.val = new_id  # Update "b" to "X", we now have "aXd".
         indexed_list.update_index(node)  # Add "aX" and "Xd" to the index.
+    indexed_list.n_skipped += len(nodes) - n_merges
+    indexed_list.drop_from_index(pair)  # It can't appear again.
+    indexed_list.maybe_compact()
+    return n_merges
+
+
+def count_pair(indexed_list, pair):  # The exact count of pair, from the index (which has all its occurrences).
+    n = 0
+    for node in indexed_list.index.get(pair, ()):
+        if node.val == pair[0] and node.next is not None and node.next.val == pair[1]:
+            n += node.weight
+    return n
+
+
+def replay(merge_tree, vocab, indexed_list):  # Apply merge_tree, without any stats.
+    for pair, new_id in merge_tree:
+        vocab[new_id] = vocab[pair[0]] + vocab[pair[1]]
+        merge(pair, new_id, indexed_list)
+    indexed_list.compact()  # So the index has each live pair exactly once, for init_stats_from_indexed_list.
 
 
-def train(text, vocab_size, verbose=False):
-    print(f'Training tokenizer on text of length {len(text):,} with vocab of size {vocab_size:,}.')
-    n_merges = vocab_size - 256
+# See as_documents for what text can be. Use indexed_list_type=CompactIndexedList for ~4x less memory (but
+# slower training), and stats_type=BucketMultiset for O(1) stats updates (ties might be broken differently).
+# metrics is a util.metrics.TrainingMetrics.
+#
+# To grow an existing vocab, pass its merge_tree as init_merge_tree: it's quickly replayed on the text and
+# only the new merges are searched for (ties might be broken differently than training from scratch).
+# If checkpoint_path is set, the training state is saved there every checkpoint_every merges and at the end,
+# and training can be continued from it with resume (with the same results as an uninterrupted run). With
+# checkpoint_merges_only, only the merge_tree and how to rebuild the rest are saved, which is much smaller and
+# quicker to save: text must then be a path, and resume replays the merges on it like init_merge_tree does.
+# batch_size > 1 merges several top pairs per commit of the stats (ties might be broken differently), see top_batch.
+# max_tracked caps the stats at that many pairs, see datastructures/spacesaving.py: the pairs are recounted with
+# count_pair before they're merged, and all of them whenever that's needed to keep each merged pair a most common
+# one (this can't be checkpointed). It caps the stats only, not the memory: the index still holds every occurrence
+# of every pair, and is usually the larger of the two.
+def train(text, vocab_size, verbose=False, split_pattern=None, indexed_list_type=IndexedList, stats_type=Multiset,
+          metrics=None, init_merge_tree=None, checkpoint_path=None, checkpoint_every=1000, batch_size=1,
+          max_tracked=None, checkpoint_merges_only=False):
+    print(f'Training tokenizer on {describe(text)} with vocab of size {vocab_size:,}.')
     vocab = {i: bytes([i]) for i in range(256)}
     merge_tree = []
-    indexed_list = timeit(lambda: build_indexed_list(text), 'build_indexed_list')
-    stats = timeit(lambda: init_pairs_stats(text), 'init_pairs_stats')
+    if max_tracked is not None:
+        if checkpoint_path is not None: raise ValueError('Approximate stats (max_tracked) can\'t be checkpointed.')
+        stats_type = lambda: SpaceSavingMultiset(max_tracked, recount=lambda pair: count_pair(indexed_list, pair),
+                                                 all_items=lambda: indexed_list.index)
+    corpus = None
+    if checkpoint_merges_only:
+        if not isinstance(text, os.PathLike): raise ValueError('checkpoint_merges_only needs text to be a path.')
+        corpus = {'text': text, 'split_pattern': split_pattern, 'indexed_list_type': indexed_list_type,
+                  'stats_type': stats_type}
+    if init_merge_tree is not None:  # Warm start.
+        if split_pattern is None:
+            indexed_list = timeit(lambda: build_documents_indexed_list(text, indexed_list_type), 'build_indexed_list')
+        else:
+            chunk_counts = timeit(lambda: count_chunks(text, split_pattern), 'count_chunks')
+            indexed_list = timeit(lambda: build_weighted_indexed_list(chunk_counts, indexed_list_type), 'build_indexed_list')
+        merge_tree = list(init_merge_tree)
+        timeit(lambda: replay(merge_tree, vocab, indexed_list), 'replay')
+        stats = timeit(lambda: init_stats_from_indexed_list(indexed_list, stats_type), 'init_pairs_stats')
+    elif split_pattern is None:  # A single pass over the input, the stats are then read off the index.
+        indexed_list = timeit(lambda: build_documents_indexed_list(text, indexed_list_type), 'build_indexed_list')
+        stats = timeit(lambda: init_stats_from_indexed_list(indexed_list, stats_type), 'init_pairs_stats')
+    else:  # Train on the unique chunks, weighted by their counts.
+        chunk_counts = timeit(lambda: count_chunks(text, split_pattern), 'count_chunks')
+        indexed_list = timeit(lambda: build_weighted_indexed_list(chunk_counts, indexed_list_type), 'build_indexed_list')
+        stats = timeit(lambda: init_weighted_pairs_stats(chunk_counts, stats_type), 'init_pairs_stats')
+    return train_loop(indexed_list, stats, merge_tree, vocab, vocab_size, verbose, metrics, checkpoint_path, checkpoint_every,
+                      batch_size, corpus)
+
+
+def resume(checkpoint_path, vocab_size, verbose=False, metrics=None, checkpoint_every=1000, batch_size=1):  # Continue a checkpointed train.
+    state = timeit(lambda: load_checkpoint(checkpoint_path), 'load_checkpoint')
+    if 'text' in state:  # Merges only, replayed on the text (ties might be broken differently than without a break).
+        return train(state['text'], vocab_size, verbose, state['split_pattern'], state['indexed_list_type'],
+                     state['stats_type'], metrics, state['merge_tree'], checkpoint_path, checkpoint_every, batch_size,
+                     checkpoint_merges_only=True)
+    print(f'Resuming training from {len(state["vocab"]):,} to vocab of size {vocab_size:,}.')
+    return train_loop(state['indexed_list'], state['stats'], state['merge_tree'], state['vocab'], vocab_size, verbose,
+                      metrics, checkpoint_path, checkpoint_every, batch_size)
+
+
+# Merging several pairs per commit of the stats: the batch is the longest prefix of stats.top_k(batch_size) with
+# no token shared by two pairs, and a pair "aa" only last. Merging a pair then doesn't change the counts of the
+# others, nor their occurrences in the index, and each pair it creates is at most as common as a pair that
+# overlapped the merged one (e.g. "xX" and "xa" for "ab" -> "X"), which isn't in the batch, so isn't more common
+# than any pair in it. So each pair is still a most common one when merged, as in serial training, with ties
+# possibly broken differently. For "aa", "Xa" can be more common than the next pairs (e.g. in "aaa"), so it ends
+# the batch. Batches are usually much shorter than batch_size, so the top pairs are fetched 8, 16, ... at a time.
+# Only the stats queries and commits are batched: each pair of the batch is still merged on its own, through its
+# index entries, in order. A single traversal of the list for the whole batch would cost O(len(list)) per batch,
+# more than visiting the batch's occurrences, which are all the merges touch.
+def top_batch(stats, batch_size):  # [(pair, count)], in merge order.
+    k = min(8, batch_size)
+    while True:
+        top = stats.top_k(k)
+        batch, tokens = [], set()
+        for pair, count in top:
+            if pair[0] in tokens or pair[1] in tokens: return batch
+            batch.append((pair, count))
+            if pair[0] == pair[1]: return batch
+            tokens.update(pair)
+        if len(top) < k or k == batch_size: return batch
+        k = min(k * 2, batch_size)
+
+
+def train_loop(indexed_list, stats, merge_tree, vocab, vocab_size, verbose=False, metrics=None,
+               checkpoint_path=None, checkpoint_every=1000, batch_size=1, corpus=None):
+    n_merges = vocab_size - len(vocab)
+    if metrics is not None: metrics.start(indexed_list, stats, batch_size > 1)
+    batch = []  # The rest of the current batch, reversed.
     for i in range(n_merges):
-        if not stats: break  # Stop if we don't have any pairs (we should probably stop earlier).
-        top_pair = stats.most_common
+        if metrics is not None: metrics.begin_merge(indexed_list, stats)
+        if not batch:
+            if not stats: break  # Stop if we don't have any pairs (we should probably stop earlier).
+            batch = top_batch(stats, batch_size)[::-1]
+        top_pair, count = batch.pop()
         new_id = len(vocab)
         merge_tree.append((top_pair, new_id))
         vocab[new_id] = vocab[top_pair[0]] + vocab[top_pair[1]]
         if verbose:
-            print(f"Merge {i+1}/{n_merges}: {top_pair} -> {new_id} ({vocab[new_id]}) had {stats.count(top_pair)} occurrences")
-        merge(top_pair, new_id, indexed_list, stats)
+            print(f"Merge {i+1}/{n_merges}: {top_pair} -> {new_id} ({vocab[new_id]}) had {count} occurrences")
+        n_merged = merge(top_pair, new_id, indexed_list, stats)
+        if metrics is not None: metrics.end_merge(i, top_pair, new_id, n_merged, indexed_list, stats)
+        if checkpoint_path is not None and (i + 1) % checkpoint_every == 0:
+            save_checkpoint(checkpoint_path, indexed_list, stats, merge_tree, vocab, corpus)
+    if checkpoint_path is not None:
+        save_checkpoint(checkpoint_path, indexed_list, stats, merge_tree, vocab, corpus)
     return merge_tree, vocab
 
 
-def tokenize(text, merge_tree):
-    l = build_indexed_list(text)
+# A checkpoint has the values of each chunk of the indexed list (its index is rebuilt on load, without the
+# stale entries), the stats as is, and the merge_tree and vocab so far. Or, given corpus (the text and the
+# arguments train builds the indexed list and stats with), just corpus and the merge_tree.
+def save_checkpoint(path, indexed_list, stats, merge_tree, vocab, corpus=None):
+    if corpus is not None:
+        state = dict(corpus, merge_tree=merge_tree)
+    else:
+        state = {'indexed_list_type': type(indexed_list), 'chunks': list(indexed_list.chunks()),
+                 'stats': stats, 'merge_tree': merge_tree, 'vocab': vocab}
+    tmp_path = os.fspath(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)  # Atomic, so a crash while saving keeps the previous checkpoint.
+
+
+def load_checkpoint(path):  # The saved state, with the indexed list rebuilt (unless it has merges only).
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if 'chunks' in state:
+        indexed_list = state['indexed_list'] = state['indexed_list_type']()
+        for vals, weight in state.pop('chunks'):
+            indexed_list.add_chunk(vals, weight)
+    return state
+
+
+def tokenize(text, merge_tree, split_pattern=None, cache=None, out=None):  # For out, see util/dataset.py.
+    vocab_size = 256 + len(merge_tree)
+    if cache is not None:  # Encode each chunk at most once, see EncodingCache.
+        cache.bind(merge_tree)
+        res = empty_tokens(vocab_size, out)
+        if split_pattern is None:
+            with open_bytes(text) as data:
+                chunks = [bytes(data)]
+        else:
+            chunks = iter_chunks(text, split_pattern)
+        for chunk in chunks:
+            tokens = cache.get(chunk)
+            if tokens is None:
+                tokens = encode_chunk(chunk, cache.ranks)
+                cache.put(chunk, tokens)
+            res.extend(tokens)
+        return as_tokens(res, vocab_size, out)
+    l = build_indexed_list(text, split_pattern)
     for pair, new_id in merge_tree:
         merge(pair, new_id, l, None)
-    return [node.val for node in l]
+    if out is None: return [node.val for node in l]
+    return as_tokens((node.val for node in l), vocab_size, out)
+
+
+# A faster encoder for inference. Instead of replaying all of merge_tree, only
+# the merges that actually occur are applied, lowest rank first, using a heap
+# over the live adjacent pairs. The cost is O(n log(n)) for an input of length
+# n, regardless of the vocab size. The output is the same as tokenize's.
+def get_ranks(merge_tree):  # Map each merged pair to its (rank, new_id).
+    if isinstance(merge_tree, MergeTree): return merge_tree.ranks  # Built once, and kept.
+    ranks = {}
+    for rank, (pair, new_id) in enumerate(merge_tree):
+        ranks.setdefault(pair, (rank, new_id))
+    return ranks
+
+
+def encode_chunk(ids, ranks):
+    ids = list(ids)
+    n = len(ids)
+    # A doubly linked list over positions, deleted positions hold None.
+    prevs, nexts = list(range(-1, n - 1)), list(range(1, n + 1))
+    heap = [(ranks[pair][0], i) for i, pair in enumerate(pairwise(ids)) if pair in ranks]
+    heapq.heapify(heap)
+    cur_rank = 0
+    while heap:
+        # Equal ranks pop left to right, same as merge walking the index.
+        rank, i = heapq.heappop(heap)
+        j = nexts[i]
+        if ids[i] is None or j == n: continue
+        rank_and_id = ranks.get((ids[i], ids[j]))
+        if rank_and_id is None or rank_and_id[0] != rank: continue  # Stale.
+        if rank < cur_rank: continue  # tokenize already went past this merge.
+        cur_rank, new_id = rank_and_id
+        # Merge "bc" to "X" in "abcd", i is "b" and j is "c".
+        ids[i], ids[j] = new_id, None
+        nexts[i] = k = nexts[j]
+        if k != n:
+            prevs[k] = i
+            if (new_id, ids[k]) in ranks:  # Push "Xd".
+                heapq.heappush(heap, (ranks[(new_id, ids[k])][0], i))
+        h = prevs[i]
+        if h != -1 and (ids[h], new_id) in ranks:  # Push "aX".
+            heapq.heappush(heap, (ranks[(ids[h], new_id)][0], h))
+    return [t for t in ids if t is not None]
+
+
+def tokenize_fast(text, ranks, split_pattern=None, out=None):  # Like tokenize, with ranks = get_ranks(merge_tree).
+    vocab_size = 256 + len(ranks)
+    if split_pattern is None:
+        with open_bytes(text) as data:
+            return as_tokens(encode_chunk(data, ranks), vocab_size, out)
+    res = empty_tokens(vocab_size, out)
+    for chunk in iter_chunks(text, split_pattern):
+        res.extend(encode_chunk(chunk, ranks))
+    return as_tokens(res, vocab_size, out)
+
+
+# An LRU cache from chunks to their tokens, for when the same chunks (e.g. words)
+# are tokenized over and over. It's tied to the merge_tree it was last used
+# with, and is cleared whenever a different (or since extended) one is passed.
+class EncodingCache(LRUCache):
+    def __init__(self, maxsize=100_000):
+        super().__init__(maxsize)
+        self.merge_tree, self.n_merges, self.ranks = None, 0, {}
+
+    def bind(self, merge_tree):
+        if merge_tree is not self.merge_tree or len(merge_tree) != self.n_merges:
+            self.clear()
+            self.merge_tree, self.n_merges = merge_tree, len(merge_tree)
+            self.ranks = get_ranks(merge_tree)
+
+    def put(self, chunk, tokens):
+        super().put(chunk, tuple(tokens))  # Immutable, as it's shared by all callers.
+
+
+# Incremental encoding of a stream (feed the bytes as they come, then flush),
+# emitting tokens as soon as no more input can change them. The output is the
+# same as tokenize's on the whole text.
+#
+# With split_pattern, a chunk is final once the text after it is long enough
+# (see split_stable_chunks), and is then encoded on its own.
+#
+# Without it, the tail not emitted yet is encoded with encode_chunk, and all the
+# tokens before a boundary p are emitted if no merge can ever cross p. If none
+# does, the tokens before p are final: merges on either side of p never look at
+# the other side. Until a merge crosses p, the token ending at p goes down the
+# right spine of the final token u ending at p: the byte before p, ..., right
+# child of u, then u itself. Each of these is around between the ranks it and
+# its parent were made at. The token starting at p is always a token whose bytes
+# are a prefix of the text after p, or start with all of it. So p is final if no
+# token c on the spine has a merge (c, y) ranked while c is around, for such a
+# token y. Only a small tail, about the length of the longest tokens, is
+# usually kept.
+#
+# Some streams have no final boundary for long (e.g. "aaaa..."), and the tail
+# grows. Past STREAM_CHECK_LEN, it's only encoded (or split) again once it has
+# doubled since the last try, so feeding n bytes costs O(n log(n)) in all
+# cases, and tokens only come out later than they could by at most the tail.
+STREAM_CHECK_LEN = 64
+
+
+class StreamingEncoder:
+    def __init__(self, merge_tree, split_pattern=None):
+        self.ranks = get_ranks(merge_tree)
+        self.split_pattern = split_pattern
+        self.tail = b'' if split_pattern is None else ''
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.next_check = 0  # The tail length to try again at.
+        self.token_bytes = {i: bytes([i]) for i in range(256)}
+        self.made = {}  # token -> (rank, pair) it was made by.
+        self.right_merges = {}  # token c -> first byte of y -> sorted [(rank, y)] of the merges (c, y).
+        for pair, (rank, new_id) in sorted(self.ranks.items(), key=lambda item: item[1]):
+            self.made.setdefault(new_id, (rank, pair))
+            self.token_bytes.setdefault(new_id, self.token_bytes[pair[0]] + self.token_bytes[pair[1]])
+            first_byte = self.token_bytes[pair[1]][0]
+            self.right_merges.setdefault(pair[0], {}).setdefault(first_byte, []).append((rank, pair[1]))
+
+    def feed(self, data):  # Returns the tokens that became final.
+        if isinstance(data, str): data = data.encode('utf-8')
+        self.tail += data if self.split_pattern is None else self.decoder.decode(data)
+        if len(self.tail) < self.next_check: return []
+        tokens = self._emit()
+        self.next_check = 2 * len(self.tail) if len(self.tail) > STREAM_CHECK_LEN else 0
+        return tokens
+
+    def _emit(self):  # Remove the final part of the tail, returning its tokens.
+        if self.split_pattern is not None:
+            chunks, self.tail = split_stable_chunks(self.tail, self.split_pattern)
+            return [t for chunk in chunks for t in encode_chunk(chunk.encode('utf-8'), self.ranks)]
+        tokens = encode_chunk(self.tail, self.ranks)
+        p = len(self.tail)
+        for k in range(len(tokens), 0, -1):  # The last final boundary, after k tokens.
+            if self.is_final(tokens[k - 1], self.tail[p:]):
+                self.tail = self.tail[p:]
+                return tokens[:k]
+            p -= len(self.token_bytes[tokens[k - 1]])
+        return []
+
+    def flush(self):  # Returns the rest of the tokens, the stream has ended.
+        if self.split_pattern is not None:
+            tail, self.tail = self.tail + self.decoder.decode(b'', final=True), ''
+            self.next_check = 0
+            return [t for chunk in split_chunks(tail, self.split_pattern) for t in encode_chunk(chunk, self.ranks)]
+        tokens, self.tail, self.next_check = encode_chunk(self.tail, self.ranks), b'', 0
+        return tokens
+
+    def is_final(self, u, after):  # Whether no merge can cross the end of u, with after (so far) after it.
+        c, end = u, float('inf')
+        while True:
+            start, pair = self.made.get(c, (-1, None))
+            merges = self.right_merges.get(c, {})
+            for ms in ([merges.get(after[0], [])] if after else merges.values()):
+                for rank, y in ms[bisect.bisect_left(ms, (start + 1,)):]:
+                    if rank >= end: break
+                    y_bytes = self.token_bytes[y]
+                    if y_bytes.startswith(after) or after.startswith(y_bytes): return False
+            if pair is None: return True
+            c, end = pair[1], start
+
+
+# Counting the tokens (e.g. for context window budgets) without tokenizing: each
+# chunk is encoded with encode_chunk, or found in a CountCache, which keeps only
+# its number of tokens (and the ranks, so they're built once per merge_tree).
+# Without cache, a module-level one is used, which isn't thread-safe: give each
+# thread its own. With limit, counting stops as soon as the count is over it
+# (and the count so far is returned), which skips the rest of the chunks.
+# Without split_pattern, text is a single chunk, so this is only known early if
+# text is too long to fit limit tokens even of the longest token's length.
+class CountCache(EncodingCache):
+    def __init__(self, maxsize=100_000):
+        super().__init__(maxsize)
+        self.max_token_len = 1
+
+    def bind(self, merge_tree):
+        ranks = self.ranks
+        super().bind(merge_tree)
+        if self.ranks is not ranks:
+            lengths = {}
+            for pair, (rank, new_id) in sorted(self.ranks.items(), key=lambda item: item[1]):
+                lengths.setdefault(new_id, lengths.get(pair[0], 1) + lengths.get(pair[1], 1))
+            self.max_token_len = max(lengths.values(), default=1)
+
+    def put(self, chunk, n_tokens):
+        LRUCache.put(self, chunk, n_tokens)
+
+
+_count_cache = CountCache()
+
+
+def count_tokens(text, merge_tree, split_pattern=None, cache=None, limit=None):
+    if cache is None: cache = _count_cache
+    cache.bind(merge_tree)
+    if split_pattern is None:  # A single chunk, not worth caching.
+        data = text.encode('utf-8')
+        if limit is not None and len(data) > limit * cache.max_token_len:  # At least this many tokens, over limit.
+            return -(-len(data) // cache.max_token_len)
+        return len(encode_chunk(data, cache.ranks))
+    n = 0
+    for match in re.finditer(split_pattern, text):
+        chunk = match.group().encode('utf-8')
+        n_tokens = cache.get(chunk)
+        if n_tokens is None:
+            n_tokens = len(encode_chunk(chunk, cache.ranks))
+            cache.put(chunk, n_tokens)
+        n += n_tokens
+        if limit is not None and n > limit: break
+    return n
+
+
+# A document split over several tasks is counted piece by piece, so it's still over limit if any piece is.
+def count_tokens_batch(texts, merge_tree, split_pattern=None, limit=None, workers=None):  # count_tokens on a process pool.
+    cache = CountCache()  # Each worker gets its own copy, and computes the ranks once.
+    split = None if split_pattern is None else partial(split_document, split_pattern=split_pattern)
+    return batch.tokenize_batch(count_tokens, texts, merge_tree, (split_pattern, cache, limit), workers, split=split,
+                                combine=sum)
+
+
+def tokenize_batch(texts, merge_tree, workers=None, split_pattern=None, out=None):  # tokenize on a process pool.
+    cache = EncodingCache()  # Each worker gets its own copy, and builds the ranks once.
+    # Large documents are split between chunks, so over several workers, if there are chunks.
+    split = None if split_pattern is None else partial(split_document, split_pattern=split_pattern)
+    return batch.tokenize_batch(tokenize_cached, texts, merge_tree, (split_pattern, cache, out), workers, split=split,
+                                combine=partial(concat_tokens, out=out))
+
+
+def tokenize_cached(text, merge_tree, split_pattern, cache, out=None):  # tokenize, always with the ranks of cache.
+    if split_pattern is None:  # A single chunk, not worth caching.
+        cache.bind(merge_tree)
+        return tokenize_fast(text, cache.ranks, None, out)
+    return tokenize(text, merge_tree, split_pattern, cache, out)
+
+
+def detokenize_bytes(seq, vocab):  # The raw bytes, which might end (or, for a slice of seq, start) mid-character.
+    return b''.join((vocab[t] for t in seq))
 
 
 def detokenize(seq, vocab):
-    return b''.join((vocab[t] for t in seq)).decode('utf-8')
+    return detokenize_bytes(seq, vocab).decode('utf-8')
 
@@ -6,7 +6,7 @@ from collections import Counter
 
 
 def merge(pair, new_id, indexed_list: IndexedList, stats:Multiset|None=None, singles_count=None):
-    for node in indexed_list.index[pair]:
+    for node in indexed_list.index.get(pair, ()):
         if node.val != pair[0] or node.next is None or node.next.val != pair[1]:
             continue  # The index was stale - continue.
         if singles_count is not None:
@@ -23,6 +23,8 @@ def merge(pair, new_id, indexed_list: IndexedList, stats:Multiset|None=None, sin
         node.next.delete()  # Delete "c", we now have "abd".
         node.val = new_id  # Update "b" to "X", we now have "aXd".
         indexed_list.update_index(node)  # Add "aX" and "Xd" to the index.
+    indexed_list.drop_from_index(pair)  # It can't appear again.
+    indexed_list.maybe_compact()
 
 
 def train(text, vocab_size, p=3, q=1, r=1, verbose=False):
@@ -37,6 +39,8 @@ def train(text, vocab_size, p=3, q=1, r=1, verbose=False):
         def key(self):
             a, b = self.val
             return pow(self.count, p) / pow(singles_count[a], q) / pow(singles_count[b], r)
+    # singles_count only changes for the new token of a merge, before any of its pairs are committed (the stats
+    # commit lazily), so a key never changes once committed, and nothing needs re-keying (see deps in Multiset).
     stats = Multiset(pairwise(t for t in text.encode('utf-8')), node_type=CondScoredNode)
     for i in range(n_merges):
         if not stats: break  # Stop if we don't have any pairs (we should probably stop earlier).
@@ -1,41 +1,27 @@
 from util.mytimeit import timeit
-from datastructures import Multiset, IndexedXList
 from functools import partial
+import multiprocessing
+import os
 try:
     from tqdm import tqdm
 except ModuleNotFoundError:
     tqdm = lambda x: x
 from bxe_with_score import build_indexed_list, merge, tokenize, detokenize, ScoredNode, init_stats_from_indexed_list
-import copy
-from itertools import pairwise
 
 
-# Reverses the merge function.
-def split(tup, new_id, indexed_list: IndexedXList, stats:Multiset|None=None):
-    n_splits = 0
-    k = len(tup)
-    assert stats is not None
-    for node in indexed_list.index[(new_id,)]:
-        if node.val != new_id: continue
-        n_splits += 1
-        # Remove old items from stats:
-        for t, _ in indexed_list.touching_nodes(node):
-            stats.remove(t)
-        # Split:
-        new_nodes = [indexed_list.Node(v) for v in tup[1:]]
-        for a, b in pairwise(new_nodes):
-            a.link(b)
-        if node.next is not None:
-            new_nodes[-1].link(node.next)
-        node.link(new_nodes[0])
-        node.val = tup[0]
-        # Update index and stats with new items:
-        for i in range(k):
-            include_prev = i == 0
-            for t, n in indexed_list.touching_nodes(node, include_prev):
-                indexed_list.add_to_index(t, n)
-                stats.add(t)
-    return n_splits
+# The lookahead runs on the live structures and then rolls all its changes back,
+# instead of copying them for each candidate: the indexed list (and its index)
+# and the stats are journaled, see StaleIndex and Multiset. The rollback is
+# exact, down to the heap layout of the stats, so every candidate is scored on
+# the same state and ties break the same way whatever the evaluation order.
+# Hence the candidates can also be scored on a pool of forked workers, forked
+# once per training, which inherit the state copy-on-write and replay the merges
+# chosen since, returning only scores.
+#
+# Note that the candidates are scored on the live stats, where the ties in the
+# greedy lookahead are broken by the current heap layout, while they used to be
+# scored on stats rebuilt from the list for each candidate, with a fresh layout.
+# So on ties the scores, and some of the chosen merges, can differ from these.
 
 
 def get_score(tup, stats, indexed_list, vocab, steps):
@@ -44,14 +30,53 @@ def get_score(tup, stats, indexed_list, vocab, steps):
     _train(indexed_list, stats, steps - 1, vocab, greedy=True, merge_counts=merge_counts)
     return sum(merge_counts)
 
-def get_top_tup(stats, indexed_list, vocab, top_k, forward_steps):
-    candidates = stats.top_k(top_k)
+def lookahead(tup, stats, indexed_list, vocab, steps):  # get_score, leaving everything as it was.
+    vocab_size = len(vocab)
+    stats.commit()
+    indexed_list.journal, stats.journal = [], []
+    try:
+        return get_score(tup, stats, indexed_list, vocab, steps)
+    finally:
+        indexed_list.rollback()
+        stats.rollback()
+        indexed_list.journal = stats.journal = None
+        for new_id in range(vocab_size, len(vocab)):
+            del vocab[new_id]
+
+_worker_state = None  # (stats, indexed_list, vocab), inherited by the forked workers.
+
+
+def _lookahead_task(args):  # merges: all the merges chosen so far, the worker applies the ones it hasn't seen.
+    tup, merges, steps = args
+    stats, indexed_list, vocab = _worker_state
+    catch_up(stats, indexed_list, vocab, merges)
+    return lookahead(tup, stats, indexed_list, vocab, steps)
+
+def catch_up(stats, indexed_list, vocab, merges):  # Apply the merges not applied yet, as _train_loop did.
+    for pair, new_id in merges:
+        if new_id >= len(vocab):
+            vocab[new_id] = b''.join([vocab[pair[i]] for i in range(len(pair))])
+            merge(pair, new_id, indexed_list, stats)
+            stats.commit()  # Like the loop does after each merge, or the heap layout (and so ties) could differ.
+
+def start_pool(stats, indexed_list, vocab, workers):  # A forked pool for get_top_tup, or None to score serially.
+    global _worker_state
+    workers = workers or os.cpu_count()
+    if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods(): return None
+    _worker_state = stats, indexed_list, vocab
+    try:
+        return multiprocessing.get_context('fork').Pool(workers)  # Forks the workers now.
+    finally:
+        _worker_state = None
+
+def get_top_tup(stats, indexed_list, vocab, top_k, forward_steps, pool=None, merges=()):
+    candidates = [tup for tup, _ in stats.top_k(top_k)]
+    if pool is not None:
+        scores = pool.map(_lookahead_task, [(tup, merges, forward_steps) for tup in candidates], chunksize=1)
+    else:
+        scores = [lookahead(tup, stats, indexed_list, vocab, forward_steps) for tup in candidates]
     best, best_score = None, 0
-    for tup, score in candidates:
-        tmp_list = IndexedXList([n.val for n in indexed_list], indexed_list.x)
-        tmp_stats = init_stats_from_indexed_list(tmp_list, stats.node_type)
-        tmp_vocab = copy.deepcopy(vocab)
-        score = get_score(tup, tmp_stats, tmp_list, tmp_vocab, forward_steps)
+    for tup, score in zip(candidates, scores):  # The first best, as when scoring serially.
         if score > best_score:
             best, best_score = tup, score
     return best
@@ -60,7 +85,7 @@ def heuristic_bpe_score(val, count):
     if len(val) > 2: return 0
     return count
 
-def train_bpe_heuristic(text, vocab_size, verbose=False, merge_counts=None):
+def train_bpe_heuristic(text, vocab_size, verbose=False, merge_counts=None, workers=1):  # workers=None for all cores.
     x = 3
     print(f'Training tokenizer on text of length {len(text):,} with vocab of size {vocab_size:,}.')
     n_merges = vocab_size - 256
@@ -69,15 +94,23 @@ def train_bpe_heuristic(text, vocab_size, verbose=False, merge_counts=None):
     indexed_list = timeit(lambda: build_indexed_list(text, x), 'build_indexed_list')
     multiset_node_type = partial(ScoredNode, key_fn=heuristic_bpe_score)
     stats = timeit(lambda: init_stats_from_indexed_list(indexed_list, multiset_node_type), 'init_stats')
-    return _train(indexed_list, stats, n_merges, vocab, merge_tree, verbose, merge_counts, greedy=False)
+    return _train(indexed_list, stats, n_merges, vocab, merge_tree, verbose, merge_counts, greedy=False, workers=workers)
+
+def _train(indexed_list, stats, n_merges, vocab, merge_tree=None, verbose=False, merge_counts=None, greedy=True, workers=1):
+    pool = None if greedy else start_pool(stats, indexed_list, vocab, workers)
+    try:
+        return _train_loop(indexed_list, stats, n_merges, vocab, merge_tree, verbose, merge_counts, greedy, pool)
+    finally:
+        if pool is not None: pool.terminate()
 
-def _train(indexed_list, stats, n_merges, vocab, merge_tree=None, verbose=False, merge_counts=None, greedy=True):
+def _train_loop(indexed_list, stats, n_merges, vocab, merge_tree, verbose, merge_counts, greedy, pool):
+    merges = []  # Since the pool was forked.
     for i in range(n_merges) if greedy else tqdm(range(n_merges)):
         if not stats: break
         if greedy:
             top_tup = stats.most_common
         else:
-            top_tup = get_top_tup(stats, indexed_list, vocab, 10, min(n_merges - i, 100))
+            top_tup = get_top_tup(stats, indexed_list, vocab, 10, min(n_merges - i, 100), pool, merges)
         if top_tup is None: break
         new_id = len(vocab)
         if not greedy:
@@ -89,6 +122,8 @@ def _train(indexed_list, stats, n_merges, vocab, merge_tree=None, verbose=False,
             count = stats.count(top_tup)
             print(f"Merge {i+1}/{n_merges}: {top_tup} -> {new_id} ({vocab[new_id]}) had {count} occurences and score {heuristic_bpe_score(top_tup, count)}")
         merge_count = merge(top_tup, new_id, indexed_list, stats)
+        if pool is not None:
+            merges.append((top_tup, new_id))
         if merge_counts is not None:
             merge_counts.append(merge_count)
     return merge_tree, vocab
@@ -0,0 +1,262 @@
+# Sharded BPE training, on all cores. Gives the same merges as bpe.train, up to
+# ties (which the heap may break differently).
+#
+# The corpus is split into n_shards contiguous shards of about the same size,
+# each with its own IndexedList in a worker process. The coordinator holds the
+# global stats: it picks the top pair, all the shards merge it locally, and
+# send back just their (aggregated) stats deltas. With split_pattern, the unique
+# chunks are dealt to the shards instead, so no pair ever spans two shards.
+#
+# Otherwise, a document can span several shards, and the pairs across the soft
+# boundaries between them are counted by the coordinator, from the tokens each
+# shard reports at its edges. bpe.merge walks the occurrences left to right, so
+# a boundary occurrence of "ab" is merged (into the left shard, the right shard
+# just drops its first token) iff it is still there when the walk gets to it:
+# - For a != b, always: occurrences of "ab" never overlap.
+# - For "aa", iff the run of "a"s that ends the left shard has an odd length,
+#   not counting a first "a" already merged into the shard before it. The
+#   coordinator asks the shards for these runs, only when needed.
+
+from multiprocessing import Pipe, Process
+from collections import Counter
+from contextlib import nullcontext
+import os
+
+from util.mytimeit import timeit
+from util.rawtext import describe, open_bytes
+from datastructures import Multiset, IndexedList
+from bpe import as_documents, count_chunks, merge
+
+
+class DeltaStats:  # Records a shard's stats updates, to be sent to the coordinator.
+    def __init__(self):
+        self.to_add, self.to_remove = {}, {}
+
+    def add(self, item, count=1):
+        self.to_add[item] = self.to_add.get(item, 0) + count
+
+    def remove(self, item, count=1):
+        self.to_remove[item] = self.to_remove.get(item, 0) + count
+
+    def flush(self):
+        res = self.to_add, self.to_remove
+        self.to_add, self.to_remove = {}, {}
+        return res
+
+
+class Shard:  # The state of a worker. soft_left/right: its first/last chunk continues in the shard before/after it.
+    def __init__(self, pieces, soft_left, soft_right):
+        self.indexed_list = IndexedList()
+        for piece, weight in pieces:
+            self.indexed_list.add_chunk(piece, weight)
+        starts = self.indexed_list.starts
+        self.soft_left = soft_left and bool(starts)
+        self.last = None
+        if soft_right and starts:
+            self.last = starts[-1]
+            while self.last.next is not None:
+                self.last = self.last.next
+        self.stats = DeltaStats()
+
+    def edges(self):  # (first, last, transparent): the tokens at the soft edges, if any.
+        first = self.indexed_list.starts[0].val if self.soft_left else None
+        last = self.last.val if self.last is not None else None
+        transparent = not self.indexed_list.starts  # Its only chunk was merged into the shard before it.
+        return first, last, transparent
+
+    def trailing_run(self):  # The length of the run ending the shard, and whether it's the whole (soft) first chunk.
+        node, n = self.last, 1
+        while node.prev is not None and node.prev.val == node.val:
+            node, n = node.prev, n + 1
+        return n, self.soft_left and node is self.indexed_list.starts[0]
+
+    def merge(self, pair, new_id, carry_in, carry_out):
+        starts = self.indexed_list.starts
+        if carry_in:  # Our first token was merged into the shard before us.
+            node = starts[0]
+            if node.next is not None:
+                self.stats.remove((node.val, node.next.val), node.weight)
+                starts[0] = node.next
+            else:
+                del starts[0]
+                self.soft_left = False
+                if node is self.last: self.last = None
+            node.delete()
+        last_prev = self.last.prev if self.last is not None else None
+        n_merged = merge(pair, new_id, self.indexed_list, self.stats)
+        if last_prev is not None and self.last.prev is None:  # The last token was merged into last_prev.
+            self.last = last_prev
+        if carry_out:  # Our last token merges with the first of the shard after us, here.
+            node = self.last
+            if node.prev is not None:
+                self.stats.remove((node.prev.val, node.val), node.weight)
+                self.stats.add((node.prev.val, new_id), node.weight)
+            node.val = new_id
+            self.indexed_list.update_index(node)
+        return n_merged, *self.stats.flush(), self.edges()
+
+
+def run_shard(conn, pieces, soft_left, soft_right):  # The worker loop, replying to the coordinator's (method, *args).
+    pieces = [(read_piece(piece), weight) for piece, weight in pieces]
+    shard = Shard(pieces, soft_left, soft_right)
+    il = shard.indexed_list
+    conn.send(({pair: il.index_weight(pair) for pair in il.index}, shard.edges()))
+    while True:
+        msg = conn.recv()
+        if msg is None: break
+        method, *args = msg
+        if method == 'chunks':
+            conn.send(list(il.chunks()))
+        else:
+            conn.send(getattr(shard, method)(*args))
+
+
+def read_piece(piece):  # bytes, or (path, start, end) to read in the worker.
+    if isinstance(piece, bytes): return piece
+    path, start, end = piece
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def split_documents(text, n_shards):
+    # Split the documents into n_shards shards of contiguous bytes, each a list of (piece, weight=1),
+    # and whether its first/last piece continues in the shard before/after it. A document is a str, a
+    # buffer (see util/rawtext.py), or a path, which is read by the workers.
+    docs = []
+    for doc in as_documents(text):
+        if isinstance(doc, str): doc = doc.encode('utf-8')  # Once, rather than for its size and again for its pieces.
+        docs.append((doc, os.path.getsize(doc) if isinstance(doc, os.PathLike) else memoryview(doc).nbytes))
+    shard_size = max(-(-sum([size for _, size in docs]) // n_shards), 1)
+    shards, pieces, free = [], [], shard_size
+    for doc, size in docs:
+        with nullcontext() if isinstance(doc, os.PathLike) else open_bytes(doc) as data:
+            start = 0
+            while start < size:
+                if not pieces: soft_left = start > 0
+                end = min(start + free, size)
+                pieces.append((bytes(data[start:end]) if data is not None else (doc, start, end), 1))
+                free -= end - start
+                start = end
+                if free == 0:
+                    shards.append((pieces, soft_left, end < size))
+                    pieces, free = [], shard_size
+    if pieces:
+        shards.append((pieces, soft_left, False))
+    return shards
+
+
+def split_chunk_counts(chunk_counts, n_shards):  # Same, for the unique chunks, which never span shards.
+    shard_size = max(-(-sum([len(chunk) for chunk in chunk_counts]) // n_shards), 1)
+    shards, pieces, size = [], [], 0
+    for chunk, count in chunk_counts.items():
+        pieces.append((chunk, count))
+        size += len(chunk)
+        if size >= shard_size:
+            shards.append((pieces, False, False))
+            pieces, size = [], 0
+    if pieces:
+        shards.append((pieces, False, False))
+    return shards
+
+
+def start_shards(shards):  # Returns the connections to the shard workers, and the initial stats and edges.
+    conns, inits = [], []
+    for pieces, soft_left, soft_right in shards:
+        conn, worker_conn = Pipe()
+        Process(target=run_shard, args=(worker_conn, pieces, soft_left, soft_right), daemon=True).start()
+        conns.append(conn)
+    for conn in conns:
+        inits.append(conn.recv())
+    return conns, inits
+
+
+def stop_shards(conns):
+    for conn in conns:
+        conn.send(None)
+        conn.close()
+
+
+def boundaries(edges):  # The (left, right) shards of each soft boundary with tokens on both sides.
+    res, left = [], None
+    for s, (first, last, transparent) in enumerate(edges):
+        if transparent: continue  # Its left and right neighbors are now adjacent.
+        if left is not None and first is not None:
+            res.append((left, s))
+        left = s if last is not None else None
+    return res
+
+
+def crossing_pairs(edges):
+    return Counter([(edges[i][1], edges[j][0]) for i, j in boundaries(edges)])
+
+
+def get_carries(pair, edges, conns):  # Whether each shard's first/last token merges across its boundary.
+    a, b = pair
+    carry_in, carry_out = [False] * len(edges), [False] * len(edges)
+    bounds = [(i, j) for i, j in boundaries(edges) if edges[i][1] == a and edges[j][0] == b]
+    if a == b:  # Depends on the runs of "a"s ending the left shards.
+        for i, _ in bounds:
+            conns[i].send(('trailing_run',))
+        runs = {i: conns[i].recv() for i, _ in bounds}
+    for i, j in bounds:
+        if a == b:
+            n, whole = runs[i]
+            if (n - (carry_in[i] and whole)) % 2 == 0: continue  # Its last "a" was merged in the shard.
+        carry_out[i] = carry_in[j] = True
+    return carry_in, carry_out
+
+
+def train(text, vocab_size, n_shards=None, verbose=False, split_pattern=None, stats_type=Multiset):
+    n_shards = n_shards or os.cpu_count()
+    print(f'Training tokenizer on {describe(text)} with vocab of size {vocab_size:,}, in {n_shards} shards.')
+    if split_pattern is None:
+        shards = timeit(lambda: split_documents(text, n_shards), 'split_documents')
+    else:
+        chunk_counts = timeit(lambda: count_chunks(text, split_pattern), 'count_chunks')
+        shards = split_chunk_counts(chunk_counts, n_shards)
+    conns, inits = timeit(lambda: start_shards(shards), 'start_shards')
+    try:
+        return train_loop(conns, inits, vocab_size, verbose, stats_type)
+    finally:
+        stop_shards(conns)
+
+
+def train_loop(conns, inits, vocab_size, verbose=False, stats_type=Multiset):
+    vocab = {i: bytes([i]) for i in range(256)}
+    merge_tree = []
+    n_merges = vocab_size - len(vocab)
+    stats = stats_type()
+    for counts, _ in inits:
+        for pair, count in counts.items():
+            stats.add(pair, count)
+    edges = [e for _, e in inits]
+    crossings = crossing_pairs(edges)
+    for pair, count in crossings.items():
+        stats.add(pair, count)
+    for i in range(n_merges):
+        if not stats: break  # Stop if we don't have any pairs (we should probably stop earlier).
+        top_pair = stats.most_common
+        new_id = len(vocab)
+        merge_tree.append((top_pair, new_id))
+        vocab[new_id] = vocab[top_pair[0]] + vocab[top_pair[1]]
+        if verbose:
+            print(f"Merge {i+1}/{n_merges}: {top_pair} -> {new_id} ({vocab[new_id]}) had {stats.count(top_pair)} occurrences")
+        carry_in, carry_out = get_carries(top_pair, edges, conns)
+        for conn, c_in, c_out in zip(conns, carry_in, carry_out):
+            conn.send(('merge', top_pair, new_id, c_in, c_out))
+        edges = []
+        for conn in conns:
+            _, to_add, to_remove, shard_edges = conn.recv()
+            for pair, count in to_add.items():
+                stats.add(pair, count)
+            for pair, count in to_remove.items():
+                stats.remove(pair, count)
+            edges.append(shard_edges)
+        new_crossings = crossing_pairs(edges)
+        for pair, count in (crossings - new_crossings).items():
+            stats.remove(pair, count)
+        for pair, count in (new_crossings - crossings).items():
+            stats.add(pair, count)
+        crossings = new_crossings
+    return merge_tree, vocab
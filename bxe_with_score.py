@@ -1,6 +1,10 @@
 from util.mytimeit import timeit
-from datastructures import Multiset, IndexedXList
+from util import batch, tupleencoder
+from util.dataset import as_tokens
+from util.rawtext import describe, open_bytes
+from datastructures import Multiset, SpaceSavingMultiset, IndexedXList
 from datastructures.multiset import Node as MultisetNode
+from datastructures.ngrams import paused_gc
 from functools import partial
 try:
     from tqdm import tqdm
@@ -8,7 +12,8 @@ except ModuleNotFoundError:
     tqdm = lambda x: x
 
 def build_indexed_list(text, x):  # Create an IndexedXList with the encoded bytes.
-    return IndexedXList((t for t in text.encode('utf-8')), x)
+    with open_bytes(text) as data:
+        return IndexedXList(data, x)
 
 
 default_score = lambda val, count: (len(val) - 1) * (count - 1)
@@ -24,14 +29,28 @@ class ScoredNode(MultisetNode):
 
 def init_stats_from_indexed_list(indexed_list: IndexedXList, node_type):
     res = Multiset(node_type=node_type)
+    with paused_gc():  # Creates a heap node per tuple, see datastructures/ngrams.py.
+        for tup, nodes in indexed_list.index.items():
+            res.add(tup, len(nodes))
+        res._commit()
+    return res
+
+def init_approx_stats(indexed_list: IndexedXList, capacity, key_fn=None):  # See datastructures/spacesaving.py.
+    res = SpaceSavingMultiset(capacity, recount=lambda tup: count_tuple(indexed_list, tup), key_fn=key_fn,
+                              all_items=lambda: indexed_list.index)
     for tup, nodes in indexed_list.index.items():
         res.add(tup, len(nodes))
     return res
 
+def count_tuple(indexed_list: IndexedXList, tup):  # The exact count of tup, from the index (which has all its occurrences).
+    k = len(tup)
+    return sum([1 for node in indexed_list.index.get(tup, ()) if node.tuple(k) == tup])
+
 def merge(tup, new_id, indexed_list: IndexedXList, stats:Multiset|None=None):
     n_merges = 0
     k = len(tup)
-    for node in indexed_list.index[tup]:
+    nodes = indexed_list.index.get(tup, ())
+    for node in nodes:
         if node.tuple(k) != tup: continue
         n_merges += 1
         # Remove old items from stats:
@@ -45,26 +64,51 @@ def merge(tup, new_id, indexed_list: IndexedXList, stats:Multiset|None=None):
                 remove_all_touching(n, False)
                 n = n.next
         # Merge:
-        for n in node.next_nodes(k)[1:]:
+        deleted = node.next_nodes(k)[1:]
+        for n in deleted:
             n.delete()
+        if indexed_list.journal is not None:
+            indexed_list.journal.append((unmerge, node, node.val, deleted))
         node.val = new_id
         indexed_list.update_index(node)
         # Add new items to stats:
         if stats is not None:
             for t, _ in indexed_list.touching_nodes(node):
                 stats.add(t)
+    indexed_list.n_skipped += len(nodes) - n_merges
+    indexed_list.drop_from_index(tup)  # It can't appear again.
+    indexed_list.maybe_compact()
     return n_merges
 
-def train(text, vocab_size, x=10, verbose=False, score_fn=None, merge_counts=None):
-    print(f'Training tokenizer on text of length {len(text):,} with vocab of size {vocab_size:,}.')
+def unmerge(node, val, deleted):  # Undo a single merge, for IndexedXList.rollback.
+    next = node.next
+    node.val = val
+    for n in deleted:
+        node.link(n)
+        node = n
+    node.next = next
+    if next is not None:
+        next.prev = node
+
+
+# metrics is a util.metrics.TrainingMetrics. max_tracked caps the stats at that many tuples (the most common ones,
+# approximately), with each winner recounted exactly from the index before it's merged, and all the tuples whenever
+# that's needed to keep the winner a most common one. The index still holds every tuple, so it's not a memory budget.
+def train(text, vocab_size, x=10, verbose=False, score_fn=None, merge_counts=None, metrics=None, max_tracked=None):
+    print(f'Training tokenizer on {describe(text)} with vocab of size {vocab_size:,}.')
     n_merges = vocab_size - 256
     vocab = {i: bytes([i]) for i in range(256)}
     merge_tree = []
     indexed_list = timeit(lambda: build_indexed_list(text, x), 'build_indexed_list')
     multiset_node_type = MultisetNode if score_fn is None else partial(ScoredNode, key_fn=score_fn)
+    if max_tracked is None:
+        stats = timeit(lambda: init_stats_from_indexed_list(indexed_list, multiset_node_type), 'init_stats')
+    else:
+        stats = timeit(lambda: init_approx_stats(indexed_list, max_tracked, score_fn), 'init_stats')
     score_fn = score_fn or default_score
-    stats = timeit(lambda: init_stats_from_indexed_list(indexed_list, multiset_node_type), 'init_stats')
+    if metrics is not None: metrics.start(indexed_list, stats)
     for i in tqdm(range(n_merges)):
+        if metrics is not None: metrics.begin_merge(indexed_list, stats)
         if not stats: break
         top_tup = stats.most_common
         new_id = len(vocab)
@@ -76,16 +120,35 @@ def train(text, vocab_size, x=10, verbose=False, score_fn=None, merge_counts=Non
         merge_count = merge(top_tup, new_id, indexed_list, stats)
         if merge_counts is not None:
             merge_counts.append(merge_count)
+        if metrics is not None: metrics.end_merge(i, top_tup, new_id, merge_count, indexed_list, stats)
     return merge_tree, vocab
 
 
-def tokenize(text, merge_tree, x):
+def tokenize(text, merge_tree, x, out=None):  # For out, see util/dataset.py.
     l = build_indexed_list(text, x)
     for pair, new_id in merge_tree:
         merge(pair, new_id, l, None)
-    return [node.val for node in l]
+    if out is None: return [node.val for node in l]
+    return as_tokens((node.val for node in l), 256 + len(merge_tree), out)
+
+
+def get_trie(merge_tree, x):  # For tokenize_fast, see util/tupleencoder.py.
+    return tupleencoder.get_trie(merge_tree, range(2, x + 1))
+
+
+def tokenize_fast(text, trie, x):  # Like tokenize, with trie = get_trie(merge_tree, x).
+    with open_bytes(text) as data:
+        return tupleencoder.encode(data, trie, x)
+
+
+def tokenize_batch(texts, merge_tree, x, workers=None, out=None):  # tokenize on a process pool.
+    return batch.tokenize_batch(tokenize, texts, merge_tree, (x, out), workers)
+
+
+def detokenize_bytes(seq, vocab):  # The raw bytes, which might end (or, for a slice of seq, start) mid-character.
+    return b''.join((vocab[t] for t in seq))
 
 
 def detokenize(seq, vocab):
-    return b''.join((vocab[t] for t in seq)).decode('utf-8')
+    return detokenize_bytes(seq, vocab).decode('utf-8')
 
@@ -1,4 +1,8 @@
 from .multiset import Multiset
+from .bucketmultiset import BucketMultiset
+from .spacesaving import SpaceSavingMultiset
 from .indexedlist import IndexedList
+from .compactindexedlist import CompactIndexedList
 from .indexedklist import IndexedKList
 from .indexedxlist import IndexedXList
+from .lrucache import LRUCache
@@ -0,0 +1,177 @@
+# Same interface as Multiset, but for items with (small) integer counts only,
+# which is all plain BPE needs. All ops cost O(1), plus a short walk when a
+# count with no bucket yet appears (see below):
+# - add(item, count), remove(item, count), count(item).
+# - most_common(): an item with the most copies.
+# - top_k(k): the k items with the most copies, in O(k).
+#
+# Internally, items are kept in buckets by count. The non-empty buckets form a
+# doubly linked list sorted by count, with a pointer to the top bucket, and are
+# found by their count in a dict. A new bucket is linked next to its neighbors,
+# which are found by walking the list from the item's old bucket, as counts
+# mostly change by a little. A walk is cut short after MAX_WALK buckets, and
+# started again from a bucket found by bisecting a sorted list of the bucket
+# counts, which isn't updated on each link and unlink (a memmove of the whole
+# list), but re-sorted only when it's too stale to land near enough.
+# Unlike Multiset, items whose count drops to 0 are removed.
+#
+# Updates are aggregated lazily, like in Multiset, and only the net change of
+# each item is committed. Like in Multiset, n_committed counts the items
+# committed, and n_sifts counts the buckets linked and unlinked.
+
+from collections import Counter, defaultdict
+import bisect
+from typing import Any
+
+MAX_WALK = 16  # Buckets walked past to find a new bucket's neighbors, before bisecting the sorted counts instead.
+
+
+class Bucket:
+    __slots__ = 'count', 'items', 'lower', 'higher'
+
+    def __init__(self, count: int, lower=None, higher=None):
+        self.count = count
+        self.items = {}  # Used as an ordered set, so ties are broken by insertion order.
+        self.lower, self.higher = lower, higher
+
+
+class BucketMultiset:
+    def __init__(self, init=None):
+        self.counts = {}  # A map from item to its count.
+        self.buckets = {}  # A map from count to its (non-empty) bucket.
+        self.sorted_counts = []  # The counts of the buckets, ascending, as of the last time they were sorted.
+        self.top = self.bottom = None
+        self.to_add = defaultdict(int)
+        self.to_remove = defaultdict(int)
+        self.to_add.update(Counter(init))
+        self.n_committed = self.n_sifts = 0
+
+    def add(self, item, count=1):
+        self.to_add[item] += count
+
+    def remove(self, item, count=1):
+        self.to_remove[item] += count
+
+    def _commit(self):
+        self.n_committed += len(self.to_add) + len(self.to_remove)
+        deltas = self.to_add
+        for item, count in self.to_remove.items():
+            deltas[item] -= count
+        for item, delta in deltas.items():
+            if delta:
+                self._set_count(item, self.counts.get(item, 0) + delta)
+        self.to_add.clear()
+        self.to_remove.clear()
+
+    def commit(self):  # Apply the pending updates now (a query would apply them anyway), e.g. to time them.
+        self._commit()
+
+    def count(self, item):
+        self._commit()
+        return self.counts.get(item, 0)
+
+    @property
+    def most_common(self):
+        self._commit()
+        return next(iter(self.top.items))
+
+    def top_k(self, k: int) -> list[tuple[Any, int]]:
+        self._commit()
+        res, bucket = [], self.top
+        while bucket is not None and len(res) < k:
+            for item in bucket.items:
+                if len(res) == k: break
+                res.append((item, bucket.count))
+            bucket = bucket.lower
+        return res
+
+    def __bool__(self):
+        self._commit()
+        return self.top is not None
+
+    def __getstate__(self):  # Flat, as pickling the linked buckets would recurse through all of them.
+        buckets, bucket = [], self.bottom
+        while bucket is not None:
+            buckets.append((bucket.count, list(bucket.items)))
+            bucket = bucket.higher
+        return {'buckets': buckets, 'counts': self.counts, 'to_add': dict(self.to_add),
+                'to_remove': dict(self.to_remove), 'n_committed': self.n_committed, 'n_sifts': self.n_sifts}
+
+    def __setstate__(self, state):
+        self.__init__()
+        lower = None
+        for count, items in state['buckets']:
+            bucket = self.buckets[count] = Bucket(count, lower)
+            bucket.items = dict.fromkeys(items)
+            if lower is None: self.bottom = bucket
+            else: lower.higher = bucket
+            lower = bucket
+        self.top = lower
+        self.counts = state['counts']
+        self.to_add.update(state['to_add'])
+        self.to_remove.update(state['to_remove'])
+        self.n_committed, self.n_sifts = state['n_committed'], state['n_sifts']
+
+    # The below functions maintain the buckets:
+
+    def _set_count(self, item, count):
+        old = self.counts.get(item, 0)
+        old_bucket = self.buckets.get(old) if old > 0 else None
+        if count > 0:
+            bucket = self.buckets.get(count)
+            if bucket is None:
+                bucket = self._new_bucket(count, old_bucket)
+            bucket.items[item] = None
+        if count:
+            self.counts[item] = count
+        else:
+            del self.counts[item]
+        if old_bucket is not None:
+            del old_bucket.items[item]
+            if not old_bucket.items:
+                self._unlink(old_bucket)
+
+    def _new_bucket(self, count, near):  # Create and link a bucket, near is a linked bucket likely close to it.
+        self.n_sifts += 1
+        lower = self._find_lower(count, near)
+        higher = self.bottom if lower is None else lower.higher
+        bucket = self.buckets[count] = Bucket(count, lower, higher)
+        if bucket.lower is None: self.bottom = bucket
+        else: bucket.lower.higher = bucket
+        if bucket.higher is None: self.top = bucket
+        else: bucket.higher.lower = bucket
+        return bucket
+
+    def _unlink(self, bucket):
+        self.n_sifts += 1
+        del self.buckets[bucket.count]
+        if bucket.lower is None: self.bottom = bucket.higher
+        else: bucket.lower.higher = bucket.higher
+        if bucket.higher is None: self.top = bucket.lower
+        else: bucket.higher.lower = bucket.lower
+
+    def _find_lower(self, count, near):  # The bucket right below count (None if there's none), for a count with no bucket.
+        if self.top is None or count > self.top.count: return self.top
+        if count < self.bottom.count: return None
+        lower = self._walk(count, near or (self.bottom if count - self.bottom.count < self.top.count - count else self.top))
+        if lower is None:  # Too far, start again from the bucket found in the sorted counts.
+            counts = self.sorted_counts
+            i = bisect.bisect_left(counts, count)
+            for i in range(i - 1, max(i - 1 - MAX_WALK, -1), -1):  # Skipping the ones unlinked since.
+                if counts[i] in self.buckets:
+                    lower = self._walk(count, self.buckets[counts[i]])
+                    break
+        if lower is None:  # Too many buckets were linked or unlinked since the sorted counts were built.
+            counts = self.sorted_counts = sorted(self.buckets)
+            lower = self.buckets[counts[bisect.bisect_left(counts, count) - 1]]
+        return lower
+
+    def _walk(self, count, bucket):  # Same as _find_lower, from bucket, but None if it's more than MAX_WALK away.
+        for _ in range(MAX_WALK):  # Neither end is passed, as count is between them.
+            if bucket.count < count:
+                if bucket.higher.count > count: return bucket
+                bucket = bucket.higher
+            else:
+                if bucket.lower.count < count: return bucket.lower
+                bucket = bucket.lower
+        return None
@@ -0,0 +1,141 @@
+# Same as IndexedList, but much more compact: instead of a Python object per
+# node, the values and the links are kept in parallel arrays of ints, and the
+# index holds positions in these arrays instead of node references. This takes
+# ~16 bytes per node (including its index entry) instead of ~70.
+#
+# It has the same interface as IndexedList (so e.g. bpe.merge works on it as is):
+# nodes are light-weight views of a position, created on access. This makes it
+# a few times slower, so it's only worth it when the IndexedList doesn't fit
+# in memory.
+
+from array import array
+from .staleindex import StaleIndex
+
+
+class CompactIndexedList(StaleIndex):
+    class Node:  # A view of a single position, with the interface of IndexedList.Node.
+        __slots__ = 'l', 'pos'
+
+        def __init__(self, l, pos):
+            self.l, self.pos = l, pos
+
+        @property
+        def val(self):
+            return self.l.vals[self.pos]
+
+        @val.setter
+        def val(self, val):
+            self.l.vals[self.pos] = val
+
+        @property
+        def prev(self):
+            pos = self.l.prevs[self.pos]
+            return None if pos == -1 else CompactIndexedList.Node(self.l, pos)
+
+        @property
+        def next(self):
+            pos = self.l.nexts[self.pos]
+            return None if pos == -1 else CompactIndexedList.Node(self.l, pos)
+
+        @property
+        def weight(self):
+            return 1 if self.l.weights is None else self.l.weights[self.pos]
+
+        def delete(self):
+            prevs, nexts, pos = self.l.prevs, self.l.nexts, self.pos
+            if prevs[pos] != -1:
+                nexts[prevs[pos]] = nexts[pos]
+            if nexts[pos] != -1:
+                prevs[nexts[pos]] = prevs[pos]
+            prevs[pos] = nexts[pos] = -1
+
+    class Positions:  # The positions of a pair in the index, iterated as nodes.
+        __slots__ = 'l', 'a'
+
+        def __init__(self, l):
+            self.l, self.a = l, array('i')
+
+        def __iter__(self):
+            l = self.l
+            for pos in self.a:  # Also sees positions appended while iterating, like a list.
+                yield CompactIndexedList.Node(l, pos)
+
+        def __len__(self):
+            return len(self.a)
+
+    def __init__(self, l=(), weight=1):
+        self.init_index()
+        self.vals, self.prevs, self.nexts = array('i'), array('i'), array('i')
+        self.weights = None  # Only allocated once there's a weighted chunk.
+        self.starts = []  # The first position of each chunk.
+        self.add_chunk(l, weight)
+
+    def add_chunk(self, l, weight=1):
+        start = len(self.vals)
+        self.vals.extend(l)
+        end = len(self.vals)
+        if end == start: return  # Empty chunk.
+        self.starts.append(start)
+        self.prevs.append(-1)
+        self.prevs.extend(range(start, end - 1))
+        self.nexts.extend(range(start + 1, end))
+        self.nexts.append(-1)
+        if weight != 1 and self.weights is None:
+            self.weights = array('q', [1]) * start
+        if self.weights is not None:
+            self.weights.extend(array('q', [weight]) * (end - start))
+        vals, n_entries = self.vals, self.n_entries
+        for pos in range(start, end - 1):
+            self._add_pos((vals[pos], vals[pos + 1]), pos)
+        self.n_live += self.n_entries - n_entries  # The new entries are all live (the older ones might not be).
+
+    def __iter__(self):
+        for pos in self.starts:
+            while pos != -1:
+                yield CompactIndexedList.Node(self, pos)
+                pos = self.nexts[pos]
+
+    def chunks(self):  # The current values of each chunk, with its weight.
+        vals, nexts = self.vals, self.nexts
+        for pos in self.starts:  # The first position of a chunk is never deleted.
+            weight, chunk = 1 if self.weights is None else self.weights[pos], array('i')
+            while pos != -1:
+                chunk.append(vals[pos])
+                pos = nexts[pos]
+            yield chunk, weight
+
+    def update_index(self, node):  # Update index before/after node.
+        pos = node.pos
+        prev, next = self.prevs[pos], self.nexts[pos]
+        if prev != -1:
+            self._add_pos((self.vals[prev], self.vals[pos]), prev)
+        if next != -1:
+            self._add_pos((self.vals[pos], self.vals[next]), pos)
+
+    def add_to_index(self, pair, node):
+        self._add_pos(pair, node.pos)
+
+    def _add_pos(self, pair, pos):
+        positions = self.index.get(pair)
+        if positions is None:
+            positions = self.index[pair] = CompactIndexedList.Positions(self)
+        positions.a.append(pos)
+        self.n_entries += 1
+
+    def _prune(self, pair, positions):  # The live positions of pair, without duplicates.
+        a, b = pair
+        vals, nexts = self.vals, self.nexts
+        seen = set()
+        res = CompactIndexedList.Positions(self)
+        for pos in positions.a:
+            if vals[pos] == a and nexts[pos] != -1 and vals[nexts[pos]] == b and pos not in seen:
+                seen.add(pos)
+                res.a.append(pos)
+        return res
+
+    def index_weight(self, pair):  # The total weight of the index entries of pair.
+        positions = self.index[pair].a
+        if self.weights is None:
+            return len(positions)
+        weights = self.weights
+        return sum([weights[pos] for pos in positions])
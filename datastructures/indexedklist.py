@@ -4,15 +4,17 @@
 # The index is stale in the sense that we only add things to it, never remove.
 # So when actually iterating on elements from the index, we need to make sure
 # that the nodes still hold the desired k-tuple.
+# The stale entries are garbage collected, see StaleIndex.
 #
 # For k=2 this is exactly the same as IndexedList (but slower so keeping both).
 
-from collections import deque
 from itertools import pairwise
 from typing import Self
+from .staleindex import StaleIndex
+from .ngrams import index_ngrams, paused_gc
 
 
-class IndexedKList:
+class IndexedKList(StaleIndex):
     class Node:
         __slots__ = 'val', 'prev', 'next'
         def __init__(self, val, prev=None, next=None):
@@ -51,22 +53,17 @@ class IndexedKList:
         def tuple(self, k):
             return tuple([n.val for n in self.next_nodes(k)])
 
-    # TODO: Maybe the impl from IndexedXList is a bit cleaner.
     def __init__(self, l, k):
         self.k = k
-        self.index = {}  # Possibly stale.
-        l = iter(l)
-        prev_nodes = deque([], maxlen=k)
-        for _ in range(k - 1):
-            prev_nodes.append(IndexedKList.Node(next(l)))
-        for a, b in pairwise(prev_nodes):
-            a.link(b)
-        self.start = prev_nodes[0]
-        for b in l:
-            prev_nodes.append(IndexedKList.Node(b))
-            prev_nodes[-2].link(prev_nodes[-1])
-            self.add_to_index(tuple([n.val for n in prev_nodes]), prev_nodes[0])
-
+        self.init_index()  # Possibly stale.
+        vals = l if isinstance(l, (bytes, bytearray, memoryview, list)) else list(l)
+        with paused_gc():
+            nodes = [IndexedKList.Node(v) for v in vals]
+            for a, b in pairwise(nodes):
+                a.link(b)
+            self.start = nodes[0] if nodes else None
+            self.index = index_ngrams(vals, (k,), nodes)
+        self.n_entries = self.n_live = max(len(nodes) - k + 1, 0)
 
     def __iter__(self):
         node = self.start
@@ -81,6 +78,17 @@ class IndexedKList:
             self.add_to_index(tuple([n.val for n in nodes[:self.k]]), nodes[0])
             nodes = nodes[1:]
 
-    def add_to_index(self, key, node):
-        self.index.setdefault(key, []).append(node)
+    def _prune(self, key, nodes):  # The live nodes of key, without duplicates.
+        seen = set()
+        res = []
+        for node in nodes:
+            if node in seen: continue
+            n = node
+            for val in key:  # Same as node.tuple(len(key)) == key, without building the tuple.
+                if n is None or n.val != val: break
+                n = n.next
+            else:
+                seen.add(node)
+                res.append(node)
+        return res
 
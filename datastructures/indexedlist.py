@@ -3,9 +3,20 @@
 # next node might contain Y. The index is stale in the sense that we only add
 # things to it, never remove. So when actually iterating on elements from the
 # index, we need to make sure that the nodes still hold the desired pairs.
-class IndexedList:
+# The stale entries are garbage collected, see StaleIndex.
+#
+# The list can hold several chunks (e.g. the words of a text), which are
+# separate linked lists sharing one index, so no pair ever spans two chunks.
+# A chunk can also have a weight, standing for that many copies of it.
+from array import array
+from .staleindex import StaleIndex
+
+
+class IndexedList(StaleIndex):
     class Node:
         __slots__ = 'val', 'prev', 'next'
+        weight = 1
+
         def __init__(self, val, prev, next):
             self.val, self.prev, self.next = val, prev, next
 
@@ -16,21 +27,44 @@ class IndexedList:
                 self.next.prev = self.prev
             self.next = self.prev = None
 
-    def __init__(self, l):
-        self.index = {}
+    class WeightedNode(Node):
+        __slots__ = 'weight',
+
+    def __init__(self, l=(), weight=1):
+        self.init_index()
+        self.starts = []  # The first node of each chunk.
+        self.add_chunk(l, weight)
+
+    def add_chunk(self, l, weight=1):
         l = iter(l)
-        a = next(l)
-        self.start = prev_node = IndexedList.Node(a, None, None)
+        a = next(l, None)
+        if a is None: return  # Empty chunk.
+        weighted = weight != 1
+        Node = IndexedList.WeightedNode if weighted else IndexedList.Node
+        prev_node = Node(a, None, None)
+        if weighted: prev_node.weight = weight
+        self.starts.append(prev_node)
+        n_entries = self.n_entries
         for b in l:
-            prev_node.next = node = IndexedList.Node(b, prev_node, None)
+            prev_node.next = node = Node(b, prev_node, None)
+            if weighted: node.weight = weight
             self.add_to_index((a, b), prev_node)
             a, prev_node = b, node
+        self.n_live += self.n_entries - n_entries  # The new entries are all live (the older ones might not be).
 
     def __iter__(self):
-        node = self.start
-        while node is not None:
-            yield node
-            node = node.next
+        for node in self.starts:
+            while node is not None:
+                yield node
+                node = node.next
+
+    def chunks(self):  # The current values of each chunk, with its weight.
+        for node in self.starts:  # The first node of a chunk is never deleted.
+            weight, vals = node.weight, array('i')
+            while node is not None:
+                vals.append(node.val)
+                node = node.next
+            yield vals, weight
 
     def update_index(self, node):  # Update index before/after node.
         if node.prev is not None:
@@ -38,6 +72,15 @@ class IndexedList:
         if node.next is not None:
             self.add_to_index((node.val, node.next.val), node)
 
-    def add_to_index(self, pair, node):
-        self.index.setdefault(pair, []).append(node)
+    def _prune(self, pair, nodes):  # The live nodes of pair, without duplicates.
+        a, b = pair
+        seen = set()
+        res = []
+        for node in nodes:
+            if node.val == a and node.next is not None and node.next.val == b and node not in seen:
+                seen.add(node)
+                res.append(node)
+        return res
 
+    def index_weight(self, pair):  # The total weight of the index entries of pair.
+        return sum([node.weight for node in self.index[pair]])
@@ -5,25 +5,31 @@
 # The index is stale in the sense that we only add things to it, never remove.
 # So when actually iterating on elements from the index, we need to make sure
 # that the nodes still hold the desired k-tuple.
+# The stale entries are garbage collected, see StaleIndex.
 #
 # Same as IndexedKList but for all k-tuples for 2 <= k <= x instead of a single k.
 # For k=2 this is exactly the same as IndexedKList (and IndexedList) but slower.
 from itertools import pairwise
 from .indexedklist import IndexedKList
+from .staleindex import StaleIndex
+from .ngrams import index_ngrams, paused_gc
 
 
-class IndexedXList:
+class IndexedXList(StaleIndex):
     Node = IndexedKList.Node
+    _prune = IndexedKList._prune
 
     def __init__(self, l, x):
         self.x = x
-        self.index = {}  # Possibly stale.
-        nodes = [IndexedXList.Node(v) for v in l]
-        for a, b in pairwise(nodes):
-            a.link(b)
-        self.start = nodes[0]
-        for n in self:
-            self.update_index(n, include_prev=False)
+        self.init_index()  # Possibly stale.
+        vals = l if isinstance(l, (bytes, bytearray, memoryview, list)) else list(l)
+        with paused_gc():
+            nodes = [IndexedXList.Node(v) for v in vals]
+            for a, b in pairwise(nodes):
+                a.link(b)
+            self.start = nodes[0] if nodes else None
+            self.index = index_ngrams(vals, range(2, x + 1), nodes)
+        self.n_entries = self.n_live = sum([len(nodes) for nodes in self.index.values()])
 
     def __iter__(self):
         node = self.start
@@ -47,5 +53,3 @@ class IndexedXList:
         for tup, n in self.touching_nodes(node, include_prev):
             self.add_to_index(tup, n)
 
-    def add_to_index(self, key, node):
-        self.index.setdefault(key, []).append(node)
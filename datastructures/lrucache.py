@@ -0,0 +1,40 @@
+# A bounded map that evicts its least recently used item when full.
+# Also counts hits and misses, to see how well the cache is doing.
+#
+# This is essentially functools.lru_cache, but as a data structure, so it can
+# be inspected and cleared by its owner (and the value doesn't have to come
+# from a single function call).
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.d = OrderedDict()  # From least to most recently used.
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        val = self.d.get(key, default)
+        if val is default:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.d.move_to_end(key)
+        return val
+
+    def put(self, key, val):
+        self.d[key] = val
+        self.d.move_to_end(key)
+        if len(self.d) > self.maxsize:
+            self.d.popitem(last=False)
+
+    def clear(self):
+        self.d.clear()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.d)
+
+    def __contains__(self, key):
+        return key in self.d
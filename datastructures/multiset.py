@@ -12,9 +12,28 @@
 # queries are much faster (see multiset_tests.ipynb).
 #
 # As a final optimization, updates are aggregated (into the to_add and to_remove
-# dicts) and only committed to the heap when needed. This pays off if we're
-# updating the same element several times before performing a query. Lazy data
-# structures are often better :)
+# dicts) and only committed to the heap when needed (or on commit()). This pays
+# off if we're updating the same element several times before performing a
+# query. Lazy data structures are often better :)
+#
+# Keys can also depend on external state (e.g. the scores of bpe_cond_score
+# depend on the counts of single tokens). Then pass deps, mapping an item to the
+# external values its key depends on (e.g. a pair to its two tokens), and call
+# touch(value) whenever value changes: this re-keys all the items depending on
+# value, which are found with a reverse index, at the next commit. Each re-keyed
+# item costs O(log(n)), instead of O(n) for re-heapifying everything.
+# The nodes must be DependentNodes, which compare by the key they had when last
+# sifted: the heap stays valid for those, so the items can be re-keyed one by
+# one even though all their keys already changed.
+#
+# Changes can also be undone, like the indices (see staleindex.py): while
+# journal is a list, every change to the nodes and the heap is logged to it, and
+# rollback() undoes them newest first, restoring the heap layout exactly (so
+# ties are broken the same way after). Start it on a committed multiset: the
+# updates still pending at the rollback are dropped.
+#
+# For profiling, n_committed counts the items committed and n_sifts the heap
+# levels moved by sifts, since the multiset was created.
 #
 # I have a shorter but slower impl here: https://yanivle.github.io/ai/2024/02/23/fast_minbpe.html
 
@@ -40,14 +59,27 @@ class Node:
         return self.key < other.key
 
 
+class DependentNode(Node):  # For keys depending on external state, see deps above.
+    __slots__ = 'cached_key',
+
+    def __lt__(self, other):
+        return self.cached_key < other.cached_key
+
+
 class Multiset:
-    def __init__(self, init=None, node_type=Node):
+    journal = None
+
+    def __init__(self, init=None, node_type=Node, deps=None):
         self.l = []  # A heap of nodes.
         self.d = {}  # A map from value to its node.
         self.node_type = node_type
         self.to_add = defaultdict(int)
         self.to_remove = defaultdict(int)
         self.to_add.update(Counter(init))
+        self.deps = deps
+        self.dependents = defaultdict(list)  # A map from an external value to the items depending on it.
+        self.to_rekey = set()
+        self.n_committed = self.n_sifts = 0
 
     def add(self, item, count=1):
         self.to_add[item] += count
@@ -55,29 +87,69 @@ class Multiset:
     def remove(self, item, count=1):
         self.to_remove[item] += count
 
+    def touch(self, value):  # The external value changed, re-key the items depending on it.
+        self.to_rekey.add(value)
+
     def _add(self, item, count=1):
         node = self.d.get(item)
         if node is None:
             node = self.d[item] = self.node_type(0, item, len(self.l))
             self.l.append(node)
+            if self.deps is not None:
+                for value in set(self.deps(item)):
+                    self.dependents[value].append(item)
+            if self.journal is not None:
+                self.journal.append((self._unnew, item))
+        self._save(node)
         node.count += count
-        self._item_increased(node.pos)
+        if self.deps is not None: self._rekey_node(node)
+        else: self._item_increased(node.pos)
 
     def _remove(self, item, count=1):
         node = self.d[item]
+        self._save(node)
         node.count -= count
-        self._item_decreased(node.pos)
+        if self.deps is not None: self._rekey_node(node)
+        else: self._item_decreased(node.pos)
         # We could actually remove items with 0-count from the list, but
         # since for some scores its helpful to have items with arbitrary
         # counts, including negative, we're never actually removing items.
 
     def _commit(self):
+        self.n_committed += len(self.to_add) + len(self.to_remove)
         for pair, count in self.to_add.items():
             self._add(pair, count)
         for pair, count in self.to_remove.items():
             self._remove(pair, count)
         self.to_add.clear()
         self.to_remove.clear()
+        if self.to_rekey:
+            self._rekey()
+
+    def _rekey(self):
+        items = {item: None for value in self.to_rekey for item in self.dependents.get(value, ())}
+        self.n_committed += len(items)
+        for item in items:
+            node = self.d[item]
+            self._save(node)
+            self._rekey_node(node)
+        self.to_rekey.clear()
+
+    def _rekey_node(self, node):  # The key may have moved either way, e.g. a touched value and the count at once.
+        node.cached_key = node.key
+        self._item_increased(node.pos)
+        self._item_decreased(node.pos)
+
+    def rollback(self):
+        for undo, *args in reversed(self.journal):
+            undo(*args)
+        self.journal.clear()
+        self.to_add.clear()
+        self.to_remove.clear()
+        self.to_rekey.clear()
+
+    def commit(self):  # Apply the pending updates now (a query would apply them anyway), e.g. to time them.
+        self._commit()
 
     def count(self, item):
         self._commit()
@@ -111,6 +183,7 @@ class Multiset:
     def _item_increased(self, pos):
         # Adapted from heapq._siftdown_max.
         node = self.l[pos]
+        start = pos
         while pos > 0:
             parentpos = (pos - 1) >> 1
             parent = self.l[parentpos]
@@ -120,13 +193,17 @@ class Multiset:
                 pos = parentpos
                 continue
             break
+        self.n_sifts += (start + 1).bit_length() - (pos + 1).bit_length()  # Levels moved up.
         self.l[pos] = node
         node.pos = pos
+        if self.journal is not None and pos != start:
+            self.journal.append((self._unsift, start, pos))
 
     def _item_decreased(self, pos):
         # Adapted from heapq._siftup_max.
         endpos = len(self.l)
         node = self.l[pos]
+        start = pos
         childpos = 2 * pos + 1  # leftmost child position
         while childpos < endpos:
             # Set childpos to index of larger child.
@@ -141,5 +218,47 @@ class Multiset:
                 childpos = 2 * pos + 1
             else:
                 break
+        self.n_sifts += (pos + 1).bit_length() - (start + 1).bit_length()  # Levels moved down.
         self.l[pos] = node
         node.pos = pos
+        if self.journal is not None and pos != start:
+            self.journal.append((self._unsift, start, pos))
+
+    # The below functions undo the journaled changes:
+
+    def _save(self, node):  # Before changing its count or key.
+        if self.journal is not None:
+            self.journal.append((self._restore, node, node.count, getattr(node, 'cached_key', None)))
+
+    def _restore(self, node, count, cached_key):
+        node.count = count
+        if self.deps is not None: node.cached_key = cached_key
+
+    def _unnew(self, item):  # Its node is the last one by now.
+        self.l.pop()
+        del self.d[item]
+        if self.deps is not None:
+            for value in set(self.deps(item)):
+                self.dependents[value].pop()
+
+    def _unsift(self, start, end):  # Move the node at end back to start, and the nodes between them back too.
+        l = self.l
+        node = l[end]
+        if start < end:  # It moved down, so start is an ancestor of end: move the path back down.
+            pos = end
+            while pos != start:
+                parentpos = (pos - 1) >> 1
+                l[pos] = l[parentpos]
+                l[pos].pos = pos
+                pos = parentpos
+        else:  # It moved up: move the path from end to start back up.
+            path, pos = [], start
+            while pos != end:
+                path.append(pos)
+                pos = (pos - 1) >> 1
+            for childpos in reversed(path):
+                l[pos] = l[childpos]
+                l[pos].pos = pos
+                pos = childpos
+        l[start] = node
+        node.pos = start
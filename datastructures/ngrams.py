@@ -0,0 +1,71 @@
+# Bulk k-gram indexing and counting, for initializing the k-tuple lists and
+# their stats in one pass over the values, instead of node by node (through
+# update_index and touching_nodes, which build a list of nodes and slice a
+# tuple per k for every node).
+#
+# The k-grams come in order of first position, and then k, the order the lists
+# used to add them in, so the stats (and training, ties included) don't change.
+#
+# count_ngrams is vectorized with NumPy if it's installed (and the input is
+# large enough for that to pay off): each k-gram is packed into an int64, the
+# packed ints are sorted, and the runs of equal ones give the k-grams, their
+# counts and (with the smallest position of each run) their order. Only the
+# distinct k-grams are then turned into tuples, and the loop over the positions
+# happens in NumPy. index_ngrams stays a Python loop, as its cost is creating
+# the entry list of each position, which NumPy can't help with.
+#
+# Bulk building creates millions of small objects and no garbage, so the cyclic
+# GC is paused meanwhile (paused_gc), as it would otherwise keep running full
+# collections over all of them for nothing.
+
+from collections import Counter
+from contextlib import contextmanager
+import gc
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+MIN_NUMPY_VALS = 1 << 12
+
+
+@contextmanager
+def paused_gc():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled: gc.enable()
+
+
+def index_ngrams(vals, ks, items):  # {k-gram: [items[i] for each position i of it]}, for all k in ks (ascending).
+    index = {}
+    n = len(vals)
+    for i, item in enumerate(items):
+        for k in ks:
+            if i + k > n: break
+            index.setdefault(tuple(vals[i:i + k]), []).append(item)
+    return index
+
+
+def count_ngrams(vals, k):  # Counter of all the k-grams, ordered like index_ngrams.
+    if np is None or len(vals) < max(MIN_NUMPY_VALS, k):
+        return Counter(zip(*[vals[j:] for j in range(k)]))
+    vals = np.asarray(memoryview(vals) if isinstance(vals, (bytes, bytearray)) else vals)
+    bits = max(int(vals.max()).bit_length(), 1)
+    if bits * k > 63:  # Doesn't fit an int64.
+        return Counter(zip(*[vals.tolist()[j:] for j in range(k)]))
+    n = len(vals) - k + 1
+    packed = np.zeros(n, np.int64)
+    for j in range(k):
+        packed = (packed << bits) | vals[j:j + n]
+    order = np.argsort(packed)
+    packed = packed[order]
+    starts = np.flatnonzero(np.r_[True, packed[1:] != packed[:-1]])
+    keys, counts = packed[starts], np.diff(np.r_[starts, n])
+    by_first = np.argsort(np.minimum.reduceat(order, starts))  # Each k-gram's first position, unique.
+    keys, counts = keys[by_first], counts[by_first]
+    mask = (1 << bits) - 1
+    cols = [((keys >> (bits * (k - 1 - j))) & mask).tolist() for j in range(k)]
+    return Counter(dict(zip(zip(*cols), counts.tolist())))
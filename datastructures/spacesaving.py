@@ -0,0 +1,173 @@
+# Same interface as Multiset, but approximate, with a bounded number of items:
+# at most capacity items are tracked, with the Space-Saving algorithm (Metwally et al.,
+# "Efficient Computation of Frequent and Top-k Elements in Data Streams").
+# An item added while all the slots are taken replaces the tracked item with
+# the lowest count, and gets floor + its added count: floor is the highest count
+# ever evicted, which bounds the count of every untracked item. So the counts of
+# the tracked items are never too low, and every item with a count above floor
+# is tracked. Removing an untracked item is a no-op.
+#
+# As counts can be too high, the winners of most_common and top_k are recounted
+# exactly with recount(item) (e.g. from the index of the indexed list) before
+# they're returned, and keep their exact counts. An item is only returned once
+# its exact count is at least the count of every other tracked item, so it's
+# exactly the most common of these (up to ties), and of all the items if its
+# count is also at least floor. Without recount, the counts are just estimates.
+#
+# floor only grows, while in BPE the counts mostly shrink, so the winners soon
+# fall below it. Then, given all_items() (e.g. the keys of the index), all the
+# items are recounted, the capacity most common ones are tracked, with exact
+# counts, and floor drops to the count of the next one. So with both recount
+# and all_items, the winners are always exactly the most common items (by count
+# if there's a key_fn), at the cost of a full recount whenever floor is hit
+# (n_rebuilds counts them). Without all_items, a winner below floor may not be.
+#
+# Only the stats are bounded, not the memory of training: the recounts rely on
+# the index of the indexed list, which still has every occurrence of every pair
+# (and takes more memory than exact stats would).
+#
+# Items are ordered by key_fn(item, count) if given (e.g. the scores of
+# bxe_with_score, which must not decrease with the count), else by count.
+#
+# Updates are aggregated lazily, like in Multiset, and committed when queried,
+# so after a whole merge: committing halfway would evict and recount items whose
+# occurrences are only partly merged. So the pending updates are only bounded by
+# the pairs a single merge touches. Two heaps of (count, item) entries find the
+# items to evict and to return, skipping stale entries (they're rebuilt once
+# they grow past 4 * capacity). n_committed counts the items committed, and
+# n_sifts the entries pushed to the heaps.
+
+from collections import defaultdict
+from typing import Any
+import heapq
+
+
+class SpaceSavingMultiset:
+    def __init__(self, capacity: int, recount=None, key_fn=None, all_items=None):
+        self.capacity, self.recount, self.key_fn, self.all_items = capacity, recount, key_fn, all_items
+        self.counts = {}  # The tracked items, with upper bounds on their counts.
+        self.exact = set()  # The tracked items whose counts are known to be exact.
+        self.floor = 0
+        self.min_heap, self.max_heap = [], []  # (count, item) and (-key, count, item), some stale.
+        self.to_add = defaultdict(int)
+        self.to_remove = defaultdict(int)
+        self.n_committed = self.n_sifts = self.n_recounts = self.n_rebuilds = 0
+
+    def add(self, item, count=1):
+        self.to_add[item] += count
+
+    def remove(self, item, count=1):
+        self.to_remove[item] += count
+
+    def _commit(self):
+        self.n_committed += len(self.to_add) + len(self.to_remove)
+        deltas = self.to_add
+        for item, count in self.to_remove.items():
+            deltas[item] -= count
+        for item, delta in deltas.items():
+            if item in self.counts:
+                if delta: self._set_count(item, self.counts[item] + delta)  # Dropped if it's down to 0.
+            elif delta > 0:
+                if len(self.counts) >= self.capacity:
+                    self._evict()
+                self._set_count(item, self.floor + delta)
+        self.to_add.clear()
+        self.to_remove.clear()
+
+    def commit(self):  # Apply the pending updates now (a query would apply them anyway), e.g. to time them.
+        self._commit()
+
+    def count(self, item):  # 0 for untracked items.
+        self._commit()
+        return self.counts.get(item, 0)
+
+    @property
+    def most_common(self):
+        return self.top_k(1)[0][0]
+
+    def top_k(self, k: int) -> list[tuple[Any, int]]:
+        self._commit()
+        res = self._top_k(k)
+        if self.all_items is not None and self.recount is not None and any(count < self.floor for _, count in res):
+            self._rebuild()  # Now no untracked item is more common than the tracked ones.
+            res = self._top_k(k)
+        return res
+
+    def _top_k(self, k):
+        res, seen = [], set()
+        while len(res) < k:
+            entry = self._pop_max()
+            if entry is None: break
+            _key, count, item = entry
+            if item in seen: continue  # A duplicate entry (its count changed and then changed back).
+            if self.recount is not None and item not in self.exact:
+                self.n_recounts += 1
+                self.exact.add(item)
+                exact_count = self.recount(item)
+                if exact_count <= 0:  # Gone.
+                    self._set_count(item, 0)
+                    continue
+                if exact_count != count:  # It'll be popped again if it's still on top.
+                    self._set_count(item, exact_count)
+                    continue
+            res.append(entry)
+            seen.add(item)
+        for entry in res:  # Put them back.
+            heapq.heappush(self.max_heap, entry)
+        return [(item, count) for _, count, item in res]
+
+    def __bool__(self):
+        if self.recount is not None: return bool(self.top_k(1))  # A count can be too high, and the item gone.
+        self._commit()
+        return bool(self.counts)
+
+    def _set_count(self, item, count):
+        if count <= 0:  # Then its exact count is 0 too.
+            del self.counts[item]
+            self.exact.discard(item)
+            return
+        self.counts[item] = count
+        key = count if self.key_fn is None else self.key_fn(item, count)
+        heapq.heappush(self.min_heap, (count, item))
+        heapq.heappush(self.max_heap, (-key, count, item))
+        self.n_sifts += 2
+        if len(self.max_heap) > 4 * self.capacity:
+            self._rebuild_heaps()
+
+    def _evict(self):
+        while True:
+            count, item = heapq.heappop(self.min_heap)
+            if self.counts.get(item) == count: break  # Otherwise stale.
+        del self.counts[item]
+        if self.recount is not None and item not in self.exact:
+            # Its bound can be far too high (e.g. floor was added to it), and would keep raising floor. The evicted
+            # items are the least common ones, so recounting them is cheap.
+            self.n_recounts += 1
+            count = self.recount(item)
+        self.exact.discard(item)
+        self.floor = max(self.floor, count)
+
+    def _pop_max(self):
+        while self.max_heap:
+            entry = heapq.heappop(self.max_heap)
+            if self.counts.get(entry[2]) == entry[1]: return entry
+        return None
+
+    def _rebuild(self):
+        self.n_rebuilds += 1
+        def counts():
+            for item in self.all_items():
+                self.n_recounts += 1
+                yield self.recount(item), item
+        top = heapq.nlargest(self.capacity + 1, counts(), key=lambda entry: entry[0])
+        self.floor = top.pop()[0] if len(top) > self.capacity else 0
+        self.counts = {item: count for count, item in top if count > 0}
+        self.exact = set(self.counts)
+        self._rebuild_heaps()
+
+    def _rebuild_heaps(self):
+        key_fn = self.key_fn or (lambda item, count: count)
+        self.min_heap = [(count, item) for item, count in self.counts.items()]
+        self.max_heap = [(-key_fn(item, count), count, item) for item, count in self.counts.items()]
+        heapq.heapify(self.min_heap)
+        heapq.heapify(self.max_heap)
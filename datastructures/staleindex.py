@@ -0,0 +1,85 @@
+# Garbage collection for the (possibly stale) indices of the indexed lists.
+#
+# The indexed lists only ever append to their index, so on long runs it fills
+# up with stale entries (deleted nodes, or nodes that no longer hold the key),
+# which also have to be skipped one by one when merging. Two things help:
+# - drop_from_index(key): once a key was merged it can never appear again (new
+#   keys always contain the new id), so its whole entry list can go.
+# - compact(): prune the dead, mismatched and duplicate entries of all keys.
+#
+# A merge always invalidates at least as many entries as it adds, so the number
+# of live entries never grows beyond its count at the last compaction, n_live.
+# Hence 1 - n_live / n_entries is a lower bound on the stale fraction, and
+# maybe_compact() compacts once it passes compact_threshold. Each compaction
+# then reclaims at least that fraction of the entries, which keeps its cost
+# amortized O(1) per added entry.
+#
+# Changes can also be undone: while journal is a list, every change to the index
+# (and to the list, by the merge functions) is logged to it as (undo_fn, *args),
+# and rollback() undoes them newest first. Compaction is off meanwhile, as it
+# could prune entries that become live again after the rollback.
+#
+# Subclasses define _prune(key, entries), returning only the live entries.
+# For profiling, the merge functions add the stale entries they skip to n_skipped.
+
+
+class StaleIndex:
+    compact_threshold = 0.5  # None to never compact.
+    journal = None
+
+    def init_index(self):
+        self.index = {}
+        self.n_entries = self.n_live = 0
+        self.n_reclaimed = self.n_compactions = self.n_skipped = 0
+
+    def add_to_index(self, key, node):
+        self.index.setdefault(key, []).append(node)
+        self.n_entries += 1
+        if self.journal is not None:
+            self.journal.append((self._unadd_to_index, key))
+
+    def _unadd_to_index(self, key):
+        entries = self.index[key]
+        entries.pop()
+        if not entries:
+            del self.index[key]
+        self.n_entries -= 1
+
+    def drop_from_index(self, key):
+        entries = self.index.pop(key, ())
+        self.n_entries -= len(entries)
+        self.n_reclaimed += len(entries)
+        if self.journal is not None and entries:
+            self.journal.append((self._undrop_from_index, key, entries))
+
+    def _undrop_from_index(self, key, entries):
+        self.index[key] = entries
+        self.n_entries += len(entries)
+        self.n_reclaimed -= len(entries)
+
+    def rollback(self):
+        for undo, *args in reversed(self.journal):
+            undo(*args)
+        self.journal.clear()
+
+    def maybe_compact(self):
+        if self.journal is None and self.compact_threshold is not None and self.n_entries > self.n_live / (1 - self.compact_threshold):
+            self.compact()
+
+    def compact(self):
+        n_entries = 0
+        for key in list(self.index):
+            entries = self._prune(key, self.index[key])
+            if entries:
+                self.index[key] = entries
+                n_entries += len(entries)
+            else:
+                del self.index[key]
+        self.n_reclaimed += self.n_entries - n_entries
+        self.n_entries = self.n_live = n_entries
+        self.n_compactions += 1
+
+    @property
+    def index_stats(self):
+        return {'n_keys': len(self.index), 'n_entries': self.n_entries, 'n_skipped': self.n_skipped,
+                'n_reclaimed': self.n_reclaimed, 'n_compactions': self.n_compactions}
@@ -0,0 +1,63 @@
+# Tests for BucketMultiset on its own: most_common and top_k must agree with a
+# Counter, for small and large count changes alike (the neighbors of a new
+# bucket are then found by walking or by bisecting), and across pickling.
+# Run with python -m pytest.
+
+from collections import Counter
+import pickle
+import random
+
+from datastructures import BucketMultiset
+
+
+def check(stats, counter):
+    stats.commit()
+    buckets, bucket = [], stats.bottom
+    while bucket is not None:
+        assert bucket.items and stats.buckets[bucket.count] is bucket
+        assert bucket.higher is None or bucket.higher.lower is bucket
+        buckets.append(bucket.count)
+        bucket = bucket.higher
+    assert buckets == sorted(set(counter.values()))
+    assert [count for _, count in stats.top_k(20)] == sorted(counter.values(), reverse=True)[:20]
+    for item, count in stats.top_k(20):
+        assert counter[item] == count
+    if counter:
+        assert counter[stats.most_common] == max(counter.values())
+
+
+def test_matches_counter():
+    rng = random.Random(0)
+    stats, counter = BucketMultiset(), Counter()
+    for i in range(20000):
+        item, delta = rng.randrange(500), rng.choice([1, 1, 2, 3, 50, 1000, rng.randrange(1, 10**6)])
+        if rng.random() < 0.4 and counter[item] >= delta:
+            stats.remove(item, delta)
+            counter[item] -= delta
+        else:
+            stats.add(item, delta)
+            counter[item] += delta
+        counter += Counter()  # Drop the zeros, as BucketMultiset does.
+        if i % 7 == 0:
+            check(stats, counter)
+        if i % 5000 == 0:
+            stats = pickle.loads(pickle.dumps(stats))
+            check(stats, counter)
+
+
+def test_distinct_counts_in_any_order():
+    rng = random.Random(1)
+    counts = list(range(1, 3001))
+    rng.shuffle(counts)
+    stats, counter = BucketMultiset(), Counter()
+    for item, count in enumerate(counts):
+        stats.add(item, count)
+        counter[item] = count
+        stats.commit()
+    check(stats, counter)
+    for item, count in enumerate(counts):
+        stats.remove(item, count - 1)
+        counter[item] = 1
+        stats.commit()
+    check(stats, counter)
+    assert len(stats.buckets) == 1
@@ -0,0 +1,54 @@
+# Regression tests for the journals of the indexed lists and the Multiset (see
+# staleindex.py and multiset.py): a rollback must restore everything exactly,
+# down to the index entries and the heap layout. Run with python -m pytest.
+
+import pathlib
+import random
+
+import bxe_with_score
+from datastructures import Multiset
+from datastructures.multiset import Node
+
+TEXT = pathlib.Path(__file__).parent.parent.joinpath('data', 'taylorswift.txt').read_text()[:5000]
+
+
+def snapshot_list(indexed_list):
+    nodes = list(indexed_list)
+    return ([(id(n), n.val, id(n.prev) if n.prev else None) for n in nodes],
+            {key: [id(n) for n in entries] for key, entries in indexed_list.index.items()},
+            indexed_list.n_entries)
+
+
+def snapshot_stats(stats):
+    return [(n.val, n.count, n.pos) for n in stats.l], {val: n.pos for val, n in stats.d.items()}
+
+
+def test_rollback_restores_list_and_stats():
+    indexed_list = bxe_with_score.build_indexed_list(TEXT, 4)
+    stats = bxe_with_score.init_stats_from_indexed_list(indexed_list, Node)
+    stats.commit()
+    list_before, stats_before = snapshot_list(indexed_list), snapshot_stats(stats)
+    indexed_list.journal, stats.journal = [], []
+    for new_id in range(256, 266):  # Merge the top tuples, as a lookahead does.
+        bxe_with_score.merge(stats.most_common, new_id, indexed_list, stats)
+    assert snapshot_list(indexed_list) != list_before
+    indexed_list.rollback()
+    stats.rollback()
+    assert snapshot_list(indexed_list) == list_before
+    assert snapshot_stats(stats) == stats_before
+
+
+def test_multiset_rollback_is_exact():
+    rng = random.Random(0)
+    for _ in range(100):
+        stats = Multiset([rng.randrange(20) for _ in range(200)])
+        stats.commit()
+        before = snapshot_stats(stats)
+        stats.journal = []
+        for _ in range(rng.randrange(1, 50)):
+            item = rng.randrange(25)
+            if rng.random() < 0.5: stats.add(item, rng.randint(1, 5))
+            elif item in stats.d: stats.remove(item, rng.randint(1, 5))
+            if rng.random() < 0.3: stats.top_k(3)
+        stats.rollback()
+        assert snapshot_stats(stats) == before
@@ -0,0 +1,44 @@
+# Tests for Multiset with keys depending on external state (deps and touch):
+# most_common and top_k must agree with a full scan, whatever mix of count
+# updates and touches lands in a commit. Run with python -m pytest.
+
+import random
+
+from datastructures import Multiset
+from datastructures.multiset import DependentNode
+
+
+def make_stats(weights):
+    class WeightedNode(DependentNode):  # The key of pair (a, b) depends on the weights of a and b.
+        @property
+        def key(self):
+            a, b = self.val
+            return self.count * weights[a] * weights[b]
+    return Multiset(node_type=WeightedNode, deps=lambda pair: pair)
+
+
+def check_heap(stats):
+    for pos in range(1, len(stats.l)):
+        assert not stats.l[(pos - 1) >> 1] < stats.l[pos]
+        assert stats.l[pos].pos == pos
+
+
+def test_deps_most_common_matches_full_scan():
+    rng = random.Random(0)
+    for _ in range(200):
+        weights = {t: rng.randint(1, 9) for t in range(8)}
+        stats = make_stats(weights)
+        for _ in range(40):
+            stats.add((rng.randrange(8), rng.randrange(8)), rng.randint(1, 5))
+        for _ in range(20):
+            for _ in range(rng.randint(1, 6)):  # Count updates and touches, in a single commit.
+                pair = (rng.randrange(8), rng.randrange(8))
+                if rng.random() < 0.5: stats.add(pair, rng.randint(1, 5))
+                elif pair in stats.d: stats.remove(pair, rng.randint(1, 3))
+                if rng.random() < 0.5:
+                    t = rng.randrange(8)
+                    weights[t] = rng.randint(1, 9)
+                    stats.touch(t)
+            best = stats.d[stats.most_common]
+            check_heap(stats)
+            assert best.key == max(node.key for node in stats.d.values())
@@ -0,0 +1,51 @@
+# Tests for tokenizing and counting tokens on a process pool (util/batch.py):
+# the results must be those of tokenize, in input order, also for paths and
+# for documents split over several workers. Run with python -m pytest.
+
+import pathlib
+import random
+import re
+
+import pytest
+
+import bpe
+
+TEXT = pathlib.Path(__file__).with_name('data').joinpath('taylorswift.txt').read_text()[:20000]
+PATTERN = bpe.GPT2_SPLIT_PATTERN
+
+
+@pytest.fixture(scope='module')
+def merge_tree():
+    return bpe.train(TEXT, 400)[0]
+
+
+def test_split_document_keeps_the_chunks():
+    rng = random.Random(0)
+    text = ''.join(rng.choice(['  ', ' a', '\n\n', "'s", "'ve", 'x', '  \n', '1 2', '!!', ' ']) for _ in range(5000))
+    for doc in (TEXT, text):
+        for max_size in (7, 100, 1000):
+            pieces = bpe.split_document(doc, max_size, PATTERN)
+            assert ''.join(pieces) == doc
+            assert [chunk for piece in pieces for chunk in re.findall(PATTERN, piece)] == re.findall(PATTERN, doc)
+
+
+@pytest.mark.parametrize('out', [None, 'array', 'numpy'])
+def test_tokenize_batch_matches_tokenize(merge_tree, tmp_path, out):
+    path = tmp_path / 'doc.txt'
+    path.write_text(TEXT[5000:])
+    docs = [TEXT * 3, path, 'short', b'a bytes doc', '']  # The first one is split over the workers.
+    expected = [bpe.tokenize(doc, merge_tree, PATTERN) for doc in [TEXT * 3, path, 'short', 'a bytes doc', '']]
+    res = bpe.tokenize_batch(docs, merge_tree, workers=3, split_pattern=PATTERN, out=out)
+    assert [list(tokens) for tokens in res] == expected
+    assert bpe.tokenize_batch(docs, merge_tree, workers=3) == [bpe.tokenize(doc, merge_tree) for doc in docs]
+
+
+@pytest.mark.parametrize('split_pattern', [None, PATTERN])
+def test_count_tokens_batch_matches_tokenize(merge_tree, split_pattern):
+    docs = [TEXT * 3, TEXT[:3000], 'short', '']
+    n_tokens = [len(bpe.tokenize(doc, merge_tree, split_pattern)) for doc in docs]
+    assert bpe.count_tokens_batch(docs, merge_tree, split_pattern, workers=3) == n_tokens
+    limit = 2000  # Over it, the counts stop early, but are still over it.
+    counts = bpe.count_tokens_batch(docs, merge_tree, split_pattern, limit, workers=3)
+    assert [n > limit for n in counts] == [n > limit for n in n_tokens]
+    assert [n for n, exact in zip(counts, n_tokens) if exact <= limit] == [n for n in n_tokens if n <= limit]
@@ -0,0 +1,84 @@
+# Regression tests for the fast paths of bpe.py, which must match the reference
+# implementations: run with python -m pytest.
+
+import pathlib
+import random
+
+import pytest
+
+import bpe
+from datastructures import BucketMultiset
+from util.decoding import StreamingDecoder, VocabTable
+
+TEXT = pathlib.Path(__file__).with_name('data').joinpath('taylorswift.txt').read_text()[:20000]
+
+
+@pytest.fixture(scope='module')
+def model():
+    return bpe.train(TEXT, 400)
+
+
+@pytest.mark.parametrize('split_pattern', [None, bpe.GPT2_SPLIT_PATTERN])
+def test_tokenize_fast_matches_tokenize(model, split_pattern):
+    merge_tree, _ = model
+    ranks = bpe.get_ranks(merge_tree)
+    for text in [TEXT[:5000], 'aaaaaaa', 'hello  world!', '', 'é日本\n\n ']:
+        assert bpe.tokenize_fast(text, ranks, split_pattern) == bpe.tokenize(text, merge_tree, split_pattern)
+
+
+@pytest.mark.parametrize('stats_type', [bpe.Multiset, BucketMultiset])
+def test_resume_matches_uninterrupted_run(tmp_path, stats_type):
+    path = tmp_path / 'checkpoint'
+    expected, _ = bpe.train(TEXT, 400, stats_type=stats_type)
+    bpe.train(TEXT, 330, stats_type=stats_type, checkpoint_path=path, checkpoint_every=25)
+    merge_tree, _ = bpe.resume(path, 400)
+    assert merge_tree == expected
+
+
+@pytest.mark.parametrize('split_pattern', [None, bpe.GPT2_SPLIT_PATTERN])
+def test_streaming_encoder_matches_tokenize(model, split_pattern):
+    merge_tree, _ = model
+    rng = random.Random(0)
+    for text in [TEXT[:5000], 'a' * 3000, ' ' * 500 + 'ab' * 200, 'é日本' * 50]:
+        encoder = bpe.StreamingEncoder(merge_tree, split_pattern)
+        data, tokens, i = text.encode('utf-8'), [], 0
+        while i < len(data):
+            n = rng.choice([1, 2, 5, 17])
+            tokens += encoder.feed(data[i:i + n])
+            i += n
+        tokens += encoder.flush()
+        assert tokens == bpe.tokenize(text, merge_tree, split_pattern)
+
+
+def test_streaming_decoder_matches_detokenize(model):
+    merge_tree, vocab = model
+    text = TEXT[:5000] + 'é日本'
+    tokens = bpe.tokenize(text, merge_tree)
+    decoder = StreamingDecoder(vocab)
+    assert ''.join(decoder.feed(t) for t in tokens) + decoder.flush() == bpe.detokenize(tokens, vocab) == text
+    with pytest.raises(ValueError):
+        decoder.feed(len(vocab))
+    with pytest.raises(ValueError):
+        decoder.feed([1, -1])
+
+@pytest.mark.parametrize('n', [10, 1000])  # Below and above MIN_NUMPY_TOKENS.
+def test_vocab_table_rejects_invalid_ids(model, n):
+    merge_tree, vocab = model
+    table = VocabTable(vocab)
+    tokens = bpe.tokenize(TEXT, merge_tree)[:n]
+    assert table.decode_bytes(tokens) == b''.join(vocab[t] for t in tokens)
+    for bad in (len(vocab), -1):
+        with pytest.raises(ValueError):
+            table.decode_bytes(tokens + [bad])
+
+
+
+@pytest.mark.parametrize('max_tracked', [300, 50])
+def test_space_saving_merges_are_most_common(max_tracked):
+    text = TEXT[:10000]
+    merge_tree, _ = bpe.train(text, 400, max_tracked=max_tracked)
+    indexed_list = bpe.build_indexed_list(text)
+    for pair, new_id in merge_tree:  # Replay, checking each merged pair against all the exact counts.
+        counts = [bpe.count_pair(indexed_list, p) for p in list(indexed_list.index)]
+        assert bpe.count_pair(indexed_list, pair) == max(counts)
+        bpe.merge(pair, new_id, indexed_list)
@@ -0,0 +1,39 @@
+# Tests for the lookahead of bpe_less_greedy: scoring the candidates on a pool
+# of workers must pick the same merges as scoring them serially, ties included.
+# Run with python -m pytest.
+
+from functools import partial
+import random
+
+import bpe_less_greedy
+from bpe_less_greedy import (ScoredNode, build_indexed_list, catch_up, heuristic_bpe_score,
+                             init_stats_from_indexed_list, merge)
+
+TEXT = ''.join(random.Random(0).choice('abcd') for _ in range(2000))  # Few symbols, so lots of ties.
+
+
+def init_state():
+    indexed_list = build_indexed_list(TEXT, 3)
+    stats = init_stats_from_indexed_list(indexed_list, partial(ScoredNode, key_fn=heuristic_bpe_score))
+    return stats, indexed_list, {i: bytes([i]) for i in range(256)}
+
+
+def test_catch_up_matches_serial_heap_layout():
+    stats, indexed_list, vocab = init_state()
+    worker_stats, worker_list, worker_vocab = init_state()
+    merges = []
+    for new_id in range(256, 266):  # The serial loop commits after each merge.
+        tup = stats.most_common
+        vocab[new_id] = b''.join([vocab[t] for t in tup])
+        merge(tup, new_id, indexed_list, stats)
+        merges.append((tup, new_id))
+    stats.commit()
+    catch_up(worker_stats, worker_list, worker_vocab, merges)  # A worker that missed all of these.
+    assert [(n.val, n.count) for n in worker_stats.l] == [(n.val, n.count) for n in stats.l]
+    assert [n.val for n in worker_list] == [n.val for n in indexed_list]
+
+
+def test_workers_match_serial_selection():
+    serial, _ = bpe_less_greedy.train_bpe_heuristic(TEXT, 280)
+    parallel, _ = bpe_less_greedy.train_bpe_heuristic(TEXT, 280, workers=3)
+    assert parallel == serial
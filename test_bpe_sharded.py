@@ -0,0 +1,37 @@
+# Tests for sharded training: the merges must be those of bpe.train, for every
+# kind of document (a str, a buffer, a path, or a list of them), with pairs
+# spanning the shards' boundaries. Run with python -m pytest.
+
+import pathlib
+
+import pytest
+
+import bpe
+import bpe_sharded
+
+TEXT = pathlib.Path(__file__).with_name('data').joinpath('taylorswift.txt').read_text()[:20000]
+
+
+@pytest.fixture(scope='module')
+def expected():
+    return bpe.train(TEXT, 400)[0]
+
+
+def test_str_and_buffer_documents(expected):
+    data = TEXT.encode('utf-8')
+    for text in [TEXT, data, memoryview(data), bytearray(data)]:
+        assert bpe_sharded.train(text, 400, n_shards=3)[0] == expected
+
+
+def test_path_and_several_documents(tmp_path):
+    paths = [tmp_path / 'a.txt', tmp_path / 'b.txt']
+    paths[0].write_text(TEXT[:12000])
+    paths[1].write_text(TEXT[12000:])
+    expected = bpe.train([TEXT[:12000], TEXT[12000:]], 400)[0]
+    assert bpe_sharded.train(paths, 400, n_shards=4)[0] == expected
+    assert bpe_sharded.train([TEXT[:12000], TEXT[12000:].encode('utf-8')], 400, n_shards=4)[0] == expected
+
+
+def test_split_pattern():
+    assert bpe_sharded.train(TEXT, 400, n_shards=3, split_pattern=bpe.GPT2_SPLIT_PATTERN)[0] == \
+        bpe.train(TEXT, 400, split_pattern=bpe.GPT2_SPLIT_PATTERN)[0]
@@ -0,0 +1,72 @@
+# Tokenize many documents on all cores, with any of the tokenize functions.
+#
+# The merge_tree is sent to each worker once, when the pool starts, instead
+# of being pickled with every task. Documents are grouped into tasks of about
+# the same total size, largest first, so one large document doesn't end up
+# last and stall the pool. A document (a str, a path or a buffer, see
+# util/rawtext.py) is sized without reading it. Given split, a document larger
+# than a task is split into pieces (e.g. between chunks, see bpe.split_document)
+# on several tasks, and their results are joined with combine. Results are
+# returned in input order.
+
+from multiprocessing import Pool
+import os
+from util.rawtext import is_buffer
+
+_worker_args = None  # (tokenize_fn, merge_tree, args), set in each worker.
+
+
+def _init_worker(tokenize_fn, merge_tree, args):
+    global _worker_args
+    _worker_args = tokenize_fn, merge_tree, args
+
+
+def _tokenize_task(task):
+    tokenize_fn, merge_tree, args = _worker_args
+    return [(i, j, tokenize_fn(text, merge_tree, *args)) for i, j, text in task]
+
+
+def doc_size(text):  # The characters of a str, or the bytes of a file or a buffer.
+    if isinstance(text, os.PathLike): return os.path.getsize(text)
+    if is_buffer(text): return memoryview(text).nbytes
+    return len(text)
+
+
+# Groups (index, piece index, piece) triples by size, largest first. Returns them and the number of pieces of each
+# document, which is 1 unless it was split with split(text, max_size).
+def make_tasks(texts, n_tasks, split=None):
+    sizes = [doc_size(text) for text in texts]
+    max_task_size = max(sum(sizes) // n_tasks, 1)
+    items, n_pieces = [], [1] * len(texts)
+    for i, text in enumerate(texts):
+        if split is not None and sizes[i] > max_task_size:
+            pieces = split(text, max_task_size)
+            n_pieces[i] = len(pieces)
+            items += [(len(piece), i, j, piece) for j, piece in enumerate(pieces)]
+        else:
+            items.append((sizes[i], i, 0, text))
+    items.sort(key=lambda item: item[0], reverse=True)
+    tasks, task, task_size = [], [], 0
+    for size, i, j, text in items:
+        if task and task_size + size > max_task_size:
+            tasks.append(task)
+            task, task_size = [], 0
+        task.append((i, j, text))
+        task_size += size
+    if task:
+        tasks.append(task)
+    return tasks, n_pieces
+
+
+def tokenize_batch(tokenize_fn, texts, merge_tree, args=(), workers=None, tasks_per_worker=8, split=None, combine=None):
+    texts = list(texts)
+    workers = workers or os.cpu_count()
+    if workers == 1 or not texts or (len(texts) == 1 and split is None):
+        return [tokenize_fn(text, merge_tree, *args) for text in texts]
+    tasks, n_pieces = make_tasks(texts, workers * tasks_per_worker, split)
+    parts = [[None] * n for n in n_pieces]
+    with Pool(workers, _init_worker, (tokenize_fn, merge_tree, args)) as pool:
+        for task_res in pool.imap_unordered(_tokenize_task, tasks):
+            for i, j, tokens in task_res:
+                parts[i][j] = tokens
+    return [part[0] if len(part) == 1 else combine(part) for part in parts]
@@ -0,0 +1,115 @@
+# Compact token outputs, and tokenized datasets for pretraining.
+#
+# tokenize can return its tokens as an array.array (out='array') or a NumPy
+# array (out='numpy') instead of a list (out=None), with the smallest unsigned
+# type that fits the vocab: 2 or 4 bytes per token, instead of a pointer and an
+# int object each. They also pickle (e.g. from tokenize_batch) as a single blob.
+#
+# write_shards streams the tokens of a corpus into shard files of shard_size
+# tokens each (the last one can be shorter), where a document can continue
+# from one shard into the next. A shard file has (little-endian):
+# - header: magic, version, itemsize (2 or 4), n_tokens, n_docs.
+# - tokens: n_tokens of itemsize bytes, padded to 8 bytes.
+# - docs: n_docs int64 positions of the tokens starting a document in the shard.
+# load_shard memory-maps both back with np.memmap.
+
+from array import array
+import struct
+import sys
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+MAGIC, VERSION = b'FMBT', 1
+HEADER = struct.Struct('<4s2I2Q')  # 28 bytes, padded to 32 so the tokens are aligned.
+HEADER_SIZE = 32
+assert sys.byteorder == 'little', 'The shard file layout assumes a little-endian machine.'
+assert array('H').itemsize == 2 and array('I').itemsize == 4
+
+
+def typecode(vocab_size):  # Of array, and also a NumPy dtype.
+    return 'H' if vocab_size <= 1 << 16 else 'I'
+
+
+# The trainers give the merged tokens the ids 256, 257, ..., so a merge_tree's vocab has 256 + len(merge_tree) ids.
+def empty_tokens(vocab_size, out):  # A list or an array to extend with tokens, then pass to as_tokens.
+    return [] if out is None else array(typecode(vocab_size))
+
+
+def as_tokens(tokens, vocab_size, out):  # tokens (any iterable of ids) as out: None (a list), 'array' or 'numpy'.
+    if out is None:
+        return tokens if isinstance(tokens, list) else list(tokens)
+    if out not in ('array', 'numpy'):
+        raise ValueError(f"out should be None, 'array' or 'numpy', not {out!r}.")
+    if not isinstance(tokens, array):
+        tokens = array(typecode(vocab_size), tokens)
+    if out == 'array':
+        return tokens
+    if np is None:
+        raise ModuleNotFoundError("out='numpy' requires numpy.")
+    return np.frombuffer(tokens, tokens.typecode)  # No copy.
+
+
+def concat_tokens(parts, out):  # The tokens of consecutive pieces of a document, each as returned by as_tokens.
+    if out == 'numpy':
+        return np.concatenate(parts)
+    res = parts[0]
+    for part in parts[1:]:
+        res.extend(part)
+    return res
+
+
+def to_array(tokens, code):  # tokens (a list, array or NumPy array) as an array of the given typecode.
+    if isinstance(tokens, array) and tokens.typecode == code:
+        return tokens
+    if np is not None and isinstance(tokens, np.ndarray):
+        return array(code, tokens.astype(code, copy=False).tobytes())
+    return array(code, tokens)
+
+
+# token_docs is an iterable of the tokens of each document, e.g. (bpe.tokenize(doc, merge_tree, out='array') for doc
+# in docs), or the chained results of tokenize_batch over groups of documents. Returns the paths of the shards.
+def write_shards(token_docs, path_prefix, vocab_size, shard_size=100_000_000):
+    code = typecode(vocab_size)
+    paths = []
+    shard, docs = array(code), array('q')
+
+    def flush():
+        nonlocal shard, docs
+        path = f'{path_prefix}_{len(paths):05d}.bin'
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, shard.itemsize, len(shard), len(docs)).ljust(HEADER_SIZE, b'\0'))
+            f.write(shard.tobytes())
+            f.write(b'\0' * (-len(shard) * shard.itemsize % 8))
+            f.write(docs.tobytes())
+        paths.append(path)
+        shard, docs = array(code), array('q')
+
+    for tokens in token_docs:
+        tokens = to_array(tokens, code)
+        if len(shard) == shard_size: flush()
+        docs.append(len(shard))
+        pos = 0
+        while pos < len(tokens):
+            if len(shard) == shard_size: flush()
+            n = min(shard_size - len(shard), len(tokens) - pos)
+            shard.extend(tokens[pos:pos + n])
+            pos += n
+    if shard or docs:
+        flush()
+    return paths
+
+
+def load_shard(path):  # Returns (tokens, docs), read-only np.memmaps of the shard file.
+    if np is None:
+        raise ModuleNotFoundError('load_shard requires numpy.')
+    with open(path, 'rb') as f:
+        magic, version, itemsize, n_tokens, n_docs = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a shard file (version {VERSION}).')
+    dtype = np.dtype(f'<u{itemsize}')
+    tokens = np.memmap(path, dtype, 'r', HEADER_SIZE, (n_tokens,)) if n_tokens else np.zeros(0, dtype)
+    docs_offset = HEADER_SIZE + n_tokens * itemsize + (-n_tokens * itemsize % 8)
+    docs = np.memmap(path, np.int64, 'r', docs_offset, (n_docs,)) if n_docs else np.zeros(0, np.int64)
+    return tokens, docs
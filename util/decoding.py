@@ -0,0 +1,86 @@
+# Fast and streaming detokenizing, for the vocabs of any of the trainers.
+#
+# VocabTable packs a vocab into a single blob with all the tokens and an offsets
+# table, the layout of util/modelfile.py (whose Vocabs are used as is), so the
+# bytes of token t are blob[offsets[t]:offsets[t + 1]], with no dict lookups.
+# decode_bytes gathers a whole token array with a few NumPy ops, if NumPy is
+# installed and the array is large enough for that to pay off, or else slices
+# the blob per token. It raises a ValueError on an id outside the vocab, which
+# would otherwise index the offsets from the end, or past them.
+#
+# StreamingDecoder turns tokens into text as they come (e.g. when generating),
+# with an incremental utf-8 decoder that holds back a character split between
+# tokens until its last byte arrives. It takes ids as ints, NumPy integers or
+# arrays.
+
+from array import array
+import codecs
+import numbers
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+from util.modelfile import Vocab
+
+MIN_NUMPY_TOKENS = 64
+
+
+class VocabTable:
+    def __init__(self, vocab):
+        if isinstance(vocab, Vocab):  # Memory-mapped, already in this layout.
+            self.offsets, self.blob = vocab.f.offsets, vocab.f.blob
+        else:
+            assert sorted(vocab) == list(range(len(vocab))), 'Token ids should be 0..len(vocab)-1.'
+            offsets, blob = array('q', [0]), bytearray()
+            for i in range(len(vocab)):
+                blob += vocab[i]
+                offsets.append(len(blob))
+            self.offsets, self.blob = memoryview(offsets), memoryview(bytes(blob))
+        if np is not None:
+            self.np_offsets = np.frombuffer(self.offsets, np.int64)
+            self.np_blob = np.frombuffer(self.blob, np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def decode_bytes(self, tokens):  # tokens is any sequence of ids, or an integer NumPy array.
+        if np is None or len(tokens) < MIN_NUMPY_TOKENS:
+            self._check(tokens)
+            blob, offsets = self.blob, self.offsets
+            return b''.join([blob[offsets[t]:offsets[t + 1]] for t in tokens])
+        tokens = np.asarray(tokens, dtype=np.int64)
+        self._check(tokens)
+        starts = self.np_offsets[tokens]
+        lengths = self.np_offsets[tokens + 1] - starts
+        ends = np.cumsum(lengths)
+        # Output byte i comes from its token's start in the blob, plus its position in the token.
+        index = np.arange(ends[-1]) + np.repeat(starts - (ends - lengths), lengths)
+        return self.np_blob[index].tobytes()
+
+    def _check(self, tokens):
+        if np is not None and isinstance(tokens, np.ndarray):
+            bad = tokens[(tokens < 0) | (tokens >= len(self))]
+            if len(bad): self._invalid(bad[0])
+            return
+        n = len(self)
+        for t in tokens:
+            if not 0 <= t < n: self._invalid(t)
+
+    def _invalid(self, token):
+        raise ValueError(f'Invalid token id {token}, the vocab has ids 0..{len(self) - 1}.')
+
+    def decode(self, tokens, errors='strict'):
+        return self.decode_bytes(tokens).decode('utf-8', errors)
+
+
+class StreamingDecoder:
+    def __init__(self, vocab, errors='strict'):  # vocab can also be a VocabTable, to share one.
+        self.table = vocab if isinstance(vocab, VocabTable) else VocabTable(vocab)
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors)
+
+    def feed(self, tokens):  # A token or tokens, returns their text up to the last complete character.
+        if isinstance(tokens, numbers.Integral): tokens = (tokens,)  # Also a NumPy integer.
+        return self.decoder.decode(self.table.decode_bytes(tokens))
+
+    def flush(self):  # The stream has ended, fails (or not, see errors) on a partial last character.
+        return self.decoder.decode(b'', final=True)
@@ -0,0 +1,67 @@
+# Per-merge training metrics, cheap enough to leave on (a few attribute reads
+# per merge). The trainers in bpe.py, bke.py and bxe_with_score.py take a
+# metrics=TrainingMetrics(sink) and record, for each merge:
+# - secs: the time spent on it, including committing the stats (see below).
+# - n_merged: the occurrences merged.
+# - n_skipped: the stale index entries skipped.
+# - n_committed, n_sifts: the Multiset items committed and heap levels sifted.
+# - n_live_nodes: the nodes left in the indexed list.
+# The stats are committed at the end of each merge, so its updates count in its
+# record, which doesn't change training, as the next query would commit them
+# right away anyway. Except with batched merges (start(..., batched=True), see
+# bpe.top_batch), which commit once per batch: then the stats are left as is,
+# and the commit is counted in the record of the first merge of the next batch.
+# A sink is any callable taking the record dict (e.g. JsonLinesSink, which
+# can be used in a with), by default the records are just kept in
+# metrics.records.
+
+import json
+import os
+import time
+
+
+class JsonLinesSink:  # Flushes every record, so a run can be followed (or killed) as it goes.
+    def __init__(self, f):  # A path or a file object, which is then left open by close.
+        self.owns_file = isinstance(f, (str, os.PathLike))
+        self.f = open(f, 'w') if self.owns_file else f
+
+    def __call__(self, record):
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def close(self):
+        if self.owns_file: self.f.close()
+        else: self.f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TrainingMetrics:
+    def __init__(self, sink=None):
+        self.records = []
+        self.sink = sink or self.records.append
+        self.n_live_nodes = 0
+
+    def start(self, indexed_list, stats, batched=False):
+        self.batched = batched
+        self.n_live_nodes = sum(1 for _ in indexed_list)
+
+    def begin_merge(self, indexed_list, stats):
+        self.start_time = time.perf_counter()
+        self.counters = indexed_list.n_skipped, stats.n_committed, stats.n_sifts
+
+    def end_merge(self, step, tup, new_id, n_merged, indexed_list, stats):
+        if not self.batched: stats.commit()  # So the merge's own updates are counted.
+        secs = time.perf_counter() - self.start_time
+        n_skipped, n_committed, n_sifts = self.counters
+        self.n_live_nodes -= n_merged * (len(tup) - 1)
+        self.sink({
+            'step': step, 'tup': tup, 'new_id': new_id, 'secs': secs, 'n_merged': n_merged,
+            'n_skipped': indexed_list.n_skipped - n_skipped,
+            'n_committed': stats.n_committed - n_committed, 'n_sifts': stats.n_sifts - n_sifts,
+            'n_live_nodes': self.n_live_nodes,
+        })
@@ -0,0 +1,113 @@
+# Save and load what train returns (merge_tree and vocab) in a flat binary
+# file, so loading is just an mmap and nothing is parsed up front.
+#
+# Layout (little-endian):
+# - header: magic, version, n_merges, width (the longest merged tuple), vocab size.
+# - merges: n_merges rows of width + 2 int32s: new_id, k, then the k-tuple
+#   padded with -1 (so this covers the k-tuples of bke and bxe_with_score too).
+# - vocab: vocab size + 1 int64 offsets into a single blob with all the tokens.
+#
+# load_model maps the file once and returns light-weight sequence and mapping
+# views over it, that read from the file on access (and pickle as just their
+# path, e.g. for tokenize_batch). The only lookup table, MergeTree.ranks (what
+# bpe.get_ranks builds), is built on first use.
+
+from collections.abc import Mapping, Sequence
+from array import array
+import mmap
+import struct
+import sys
+
+MAGIC, VERSION = b'FMBP', 1
+HEADER = struct.Struct('<4s4I')  # 20 bytes, padded to 24 so the int64 offsets are aligned.
+HEADER_SIZE = 24
+assert sys.byteorder == 'little', 'The model file layout assumes a little-endian machine.'
+
+
+def save_model(path, merge_tree, vocab):
+    assert sorted(vocab) == list(range(len(vocab))), 'Token ids should be 0..len(vocab)-1.'
+    width = max((len(tup) for tup, _ in merge_tree), default=2)
+    merges = array('i')
+    for tup, new_id in merge_tree:
+        merges.extend((new_id, len(tup)) + tuple(tup) + (-1,) * (width - len(tup)))
+    offsets, blob = array('q', [0]), bytearray()
+    for i in range(len(vocab)):
+        blob += vocab[i]
+        offsets.append(len(blob))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(merge_tree), width, len(vocab)).ljust(HEADER_SIZE, b'\0'))
+        f.write(merges.tobytes())
+        f.write(b'\0' * (-len(merges) * merges.itemsize % 8))
+        f.write(offsets.tobytes())
+        f.write(blob)
+
+
+class ModelFile:  # The sections of a memory-mapped model file.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_merges, self.width, self.vocab_size = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a model file (version {VERSION}).')
+        buf, pos = memoryview(self.mm), HEADER_SIZE
+        merges_size = self.n_merges * (self.width + 2) * 4
+        self.merges = buf[pos:pos + merges_size].cast('i')
+        pos += merges_size + (-merges_size % 8)
+        self.offsets = buf[pos:pos + (self.vocab_size + 1) * 8].cast('q')
+        self.blob = buf[pos + (self.vocab_size + 1) * 8:]
+
+
+class MergeTree(Sequence):  # A read-only merge_tree, list of (tuple, new_id).
+    def __init__(self, f):  # A path or a ModelFile.
+        self.f = f if isinstance(f, ModelFile) else ModelFile(f)
+        self._ranks = None
+
+    def __len__(self):
+        return self.f.n_merges
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        row = (i % len(self)) * (self.f.width + 2)
+        new_id, k = self.f.merges[row], self.f.merges[row + 1]
+        return tuple(self.f.merges[row + 2:row + 2 + k]), new_id
+
+    @property
+    def ranks(self):  # Map each merged tuple to its (rank, new_id), the first if it's merged more than once.
+        if self._ranks is None:
+            ranks, merges, row_size = {}, self.f.merges, self.f.width + 2
+            for rank, row in enumerate(range(0, len(merges), row_size)):
+                k = merges[row + 1]
+                ranks.setdefault(tuple(merges[row + 2:row + 2 + k]), (rank, merges[row]))
+            self._ranks = ranks
+        return self._ranks
+
+    def __reduce__(self):
+        return MergeTree, (self.f.path,)
+
+
+class Vocab(Mapping):  # A read-only vocab, dict from token id to its bytes.
+    def __init__(self, f):  # A path or a ModelFile.
+        self.f = f if isinstance(f, ModelFile) else ModelFile(f)
+
+    def __len__(self):
+        return self.f.vocab_size
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __getitem__(self, t):
+        if not 0 <= t < len(self):
+            raise KeyError(t)
+        return bytes(self.f.blob[self.f.offsets[t]:self.f.offsets[t + 1]])
+
+    def __reduce__(self):
+        return Vocab, (self.f.path,)
+
+
+def load_model(path):
+    f = ModelFile(path)
+    return MergeTree(f), Vocab(f)
@@ -0,0 +1,53 @@
+# Training and tokenizing can work on the raw bytes, without a decode. Besides a
+# str, text can be a path (os.PathLike) to a utf-8 file, which is memory-mapped,
+# or any object with the buffer protocol holding utf-8 bytes (bytes, bytearray,
+# memoryview, mmap, a NumPy uint8 array, ...). Its bytes are then used as is,
+# so a file's contents, their decoded str and its encoding never all exist at
+# the same time.
+
+from contextlib import contextmanager
+import codecs
+import mmap
+import os
+
+BLOCK_SIZE = 1 << 20
+
+
+def is_buffer(obj):
+    try:
+        memoryview(obj)
+    except TypeError:
+        return False
+    return True
+
+
+def describe(text):  # For the "Training tokenizer on ..." messages.
+    if isinstance(text, str): return f'text of length {len(text):,}'
+    if isinstance(text, os.PathLike): return f'{text}'
+    if is_buffer(text): return f'{memoryview(text).nbytes:,} bytes'
+    return 'documents'
+
+
+@contextmanager
+def open_bytes(text):  # The utf-8 bytes of text, as a sequence of ints (bytes or a memoryview), valid inside the with.
+    if isinstance(text, str):
+        yield text.encode('utf-8')
+    elif isinstance(text, os.PathLike):
+        with open(text, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b''  # Empty files can't be mapped.
+                return
+            # Unmapped once the last view of it is gone, rather than failing to close if a caller kept a slice.
+            with memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as data:
+                yield data
+    else:
+        with memoryview(text) as data:
+            yield data.cast('B')
+
+
+def iter_text(text):  # The decoded text of a path or a buffer, in blocks (e.g. for splitting it into chunks).
+    with open_bytes(text) as data:
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for start in range(0, len(data), BLOCK_SIZE):
+            yield decoder.decode(data[start:start + BLOCK_SIZE])
+        yield decoder.decode(b'', final=True)
@@ -0,0 +1,49 @@
+# Tests for compact token outputs and shard files: the tokens must come back
+# unchanged, whatever their type, with documents continuing across shards.
+# Run with python -m pytest.
+
+from array import array
+import pickle
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')  # load_shard needs it.
+
+from util.dataset import as_tokens, load_shard, write_shards
+
+
+@pytest.mark.parametrize('vocab_size, code', [(300, 'H'), (1 << 16, 'H'), ((1 << 16) + 1, 'I')])
+def test_as_tokens(vocab_size, code):
+    tokens = [0, 5, vocab_size - 1]
+    assert as_tokens(tokens, vocab_size, None) is tokens
+    res = as_tokens(tokens, vocab_size, 'array')
+    assert isinstance(res, array) and res.typecode == code and list(res) == tokens
+    assert pickle.loads(pickle.dumps(res)) == res
+    res = as_tokens(iter(tokens), vocab_size, 'numpy')
+    assert res.dtype == np.dtype(code) and res.tolist() == tokens
+    with pytest.raises(ValueError):
+        as_tokens(tokens, vocab_size, 'tuple')
+
+
+@pytest.mark.parametrize('vocab_size', [300, 100_000])
+def test_shards_round_trip(tmp_path, vocab_size):
+    rng = random.Random(0)
+    docs = [[rng.randrange(vocab_size) for _ in range(rng.choice([0, 1, 7, 30, 100]))] for _ in range(50)]
+    as_types = [list, lambda d: array('I', d), lambda d: np.array(d, np.int64)]  # Converted to the shards' type.
+    paths = write_shards((as_types[i % 3](doc) for i, doc in enumerate(docs)), tmp_path / 'shard', vocab_size, 64)
+    all_tokens, starts = [], []
+    for i, path in enumerate(paths):
+        tokens, doc_starts = load_shard(path)
+        assert len(tokens) == 64 or i == len(paths) - 1
+        assert tokens.dtype.itemsize == (2 if vocab_size <= 1 << 16 else 4)
+        starts += [len(all_tokens) + start for start in doc_starts.tolist()]
+        all_tokens += tokens.tolist()
+    assert [all_tokens[start:end] for start, end in zip(starts, starts[1:] + [len(all_tokens)])] == docs
+
+
+def test_not_a_shard_file(tmp_path):
+    path = tmp_path / 'shard.bin'
+    path.write_bytes(b'not a shard' * 10)
+    with pytest.raises(ValueError):
+        load_shard(path)
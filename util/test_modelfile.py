@@ -0,0 +1,50 @@
+# Tests for the binary model file: a saved model must load back as the same
+# merge_tree and vocab, for pairs and for the k-tuples of bke, and tokenize the
+# same. Run with python -m pytest.
+
+import pathlib
+import pickle
+
+import pytest
+
+import bke
+import bpe
+from util.modelfile import MergeTree, Vocab, load_model, save_model
+
+TEXT = pathlib.Path(__file__).parent.parent.joinpath('data', 'taylorswift.txt').read_text()[:5000]
+
+
+@pytest.mark.parametrize('train', [lambda: bpe.train(TEXT, 300), lambda: bke.train(TEXT, 300, k=3)])
+def test_round_trip(tmp_path, train):
+    merge_tree, vocab = train()
+    path = tmp_path / 'model.bin'
+    save_model(path, merge_tree, vocab)
+    loaded_tree, loaded_vocab = load_model(path)
+    assert list(loaded_tree) == [(tuple(tup), new_id) for tup, new_id in merge_tree]
+    assert loaded_tree[-1] == loaded_tree[len(merge_tree) - 1] and loaded_tree[1:3] == list(loaded_tree)[1:3]
+    with pytest.raises(IndexError):
+        loaded_tree[len(merge_tree)]
+    assert dict(loaded_vocab) == vocab
+    with pytest.raises(KeyError):
+        loaded_vocab[len(vocab)]
+    unpickled_tree, unpickled_vocab = pickle.loads(pickle.dumps((loaded_tree, loaded_vocab)))
+    assert isinstance(unpickled_tree, MergeTree) and isinstance(unpickled_vocab, Vocab)
+    assert list(unpickled_tree) == list(loaded_tree) and dict(unpickled_vocab) == vocab
+
+
+def test_loaded_model_tokenizes_the_same(tmp_path):
+    merge_tree, vocab = bpe.train(TEXT, 300)
+    path = tmp_path / 'model.bin'
+    save_model(path, merge_tree, vocab)
+    loaded_tree, loaded_vocab = load_model(path)
+    assert loaded_tree.ranks == bpe.get_ranks(merge_tree)
+    tokens = bpe.tokenize(TEXT, merge_tree)
+    assert bpe.tokenize(TEXT, loaded_tree) == tokens
+    assert bpe.detokenize(tokens, loaded_vocab) == TEXT
+
+
+def test_not_a_model_file(tmp_path):
+    path = tmp_path / 'model.bin'
+    path.write_bytes(b'not a model' * 10)
+    with pytest.raises(ValueError):
+        load_model(path)
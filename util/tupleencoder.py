@@ -0,0 +1,73 @@
+# A fast encoder for the k-tuple merge trees of bke and bxe_with_score, the
+# counterpart of bpe.encode_chunk. Instead of building the full k-tuple index
+# and replaying all of merge_tree, only the merges that actually occur are
+# applied, lowest rank first, using a heap of (rank, position) over the tuples
+# that currently match.
+#
+# The merged tuples are looked up with a trie, so finding all the tuples that
+# start at a position costs at most one step per token of the longest tuple.
+# After a merge, only the positions whose tuples can include the new token (the
+# max_len - 1 before it and itself) are rescanned.
+#
+# The output is the same as tokenize's: all the occurrences of a tuple only
+# ever appear together, when its newest token is created (a new tuple always
+# holds the new token), and merge walks them left to right, as the heap does.
+
+import heapq
+
+RANK = None  # The key of a trie node's (rank, new_id), if a tuple ends there.
+
+
+def get_trie(merge_tree, lengths):  # Only tuples with a length in lengths are merged, as by the indexed lists.
+    trie = {}
+    for rank, (tup, new_id) in enumerate(merge_tree):
+        if len(tup) not in lengths: continue
+        node = trie
+        for t in tup:
+            node = node.setdefault(t, {})
+        node.setdefault(RANK, (rank, new_id))
+    return trie
+
+
+def encode(ids, trie, max_len):  # trie = get_trie(merge_tree, lengths), max_len = max(lengths).
+    ids = list(ids)
+    n = len(ids)
+    # A doubly linked list over positions, deleted positions hold None.
+    prevs, nexts = list(range(-1, n - 1)), list(range(1, n + 1))
+
+    def matches(i):  # (rank, new_id, end) for each tuple starting at i, end is the position after it.
+        node = trie
+        while i != n:
+            node = node.get(ids[i])
+            if node is None: return
+            i = nexts[i]
+            if RANK in node:
+                yield (*node[RANK], i)
+
+    heap = [(rank, i) for i in range(n) for rank, _, _ in matches(i)]
+    heapq.heapify(heap)
+    cur_rank = 0
+    while heap:
+        # Equal ranks pop left to right, same as merge walking the index.
+        rank, i = heapq.heappop(heap)
+        if ids[i] is None or rank < cur_rank: continue
+        match = next((m for m in matches(i) if m[0] == rank), None)
+        if match is None: continue  # Stale.
+        cur_rank, new_id, end = match
+        # Merge "bcd" to "X" in "abcde", i is "b" and end is "e".
+        j = nexts[i]
+        while j != end:
+            ids[j] = None
+            j = nexts[j]
+        ids[i], nexts[i] = new_id, end
+        if end != n:
+            prevs[end] = i
+        # Push the tuples holding X, those starting at X or up to max_len - 1 before it.
+        h = i
+        for _ in range(max_len):
+            for rank, _, end in matches(h):
+                if h == i or end > i:
+                    heapq.heappush(heap, (rank, h))
+            h = prevs[h]
+            if h == -1: break
+    return [t for t in ids if t is not None]